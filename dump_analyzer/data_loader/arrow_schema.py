@@ -0,0 +1,122 @@
+import inspect
+import pyarrow as pa
+from enum import Enum
+from pydantic import BaseModel
+from typing import Any, Dict, List, Literal, Type, Union, get_args, get_origin
+
+RP_ID_TYPE_FIELDS = {
+    "rp_id": "id",
+    "rp_type": "type",
+    "rp_publisher": "publisher",
+}
+
+PRIMITIVE_TYPES = {
+    str: pa.string(),
+    int: pa.int64(),
+    float: pa.float64(),
+    bool: pa.bool_(),
+}
+
+
+def unwrap_optional(annotation: Any) -> Any:
+    """
+    Strip Optional[...] from a type annotation.
+    """
+    if get_origin(annotation) is Union:
+        args = [arg for arg in get_args(annotation) if arg is not type(None)]
+        if len(args) == 1:
+            return args[0]
+    return annotation
+
+
+def get_item_type(annotation: Any) -> Any:
+    """
+    Get the type of a single item of a field, stripping Optional[...] and List[...].
+    """
+    annotation = unwrap_optional(annotation)
+    if get_origin(annotation) in (list, List):
+        annotation = unwrap_optional(get_args(annotation)[0])
+    return annotation
+
+
+def is_model(annotation: Any) -> bool:
+    """
+    Check whether a type annotation is a pydantic model.
+    """
+    return inspect.isclass(annotation) and issubclass(annotation, BaseModel)
+
+
+def get_arrow_type(annotation: Any) -> pa.DataType:
+    """
+    Get the Arrow type matching the values of a field after model.dict().
+    Parameters:
+        annotation (Any): The type annotation of a pydantic field.
+    Returns:
+        pa.DataType: The Arrow type, nested models are mapped to structs of their fields.
+    """
+    annotation = unwrap_optional(annotation)
+    origin = get_origin(annotation)
+
+    if origin in (list, List):
+        return pa.list_(get_arrow_type(get_args(annotation)[0]))
+    if origin in (dict, Dict):
+        key_type, value_type = get_args(annotation)
+        return pa.map_(get_arrow_type(key_type), get_arrow_type(value_type))
+    if origin is Literal:
+        return PRIMITIVE_TYPES.get(type(get_args(annotation)[0]), pa.string())
+    if origin is Union:
+        return pa.string()
+    if is_model(annotation):
+        return pa.struct(
+            [
+                pa.field(name, get_arrow_type(field.annotation))
+                for name, field in annotation.__fields__.items()
+            ]
+        )
+    if inspect.isclass(annotation) and issubclass(annotation, Enum):
+        return pa.string()
+    return PRIMITIVE_TYPES.get(annotation, pa.string())
+
+
+def get_rp_id_type_schema(model: Type[BaseModel]) -> List[pa.Field]:
+    """
+    Get the rp_* columns added to every row of a nested field.
+    They repeat the same few values on consecutive rows, so they are dictionary-encoded.
+    """
+    return [
+        pa.field(
+            column,
+            pa.dictionary(pa.int32(), get_arrow_type(model.__fields__[field_name].annotation)),
+        )
+        for column, field_name in RP_ID_TYPE_FIELDS.items()
+    ]
+
+
+def get_nested_field_schema(model: Type[BaseModel], field_name: str) -> pa.Schema:
+    """
+    Get the schema of the <collection>_<field>.parquet file of a nested field.
+    Columns of a nested model are prefixed with the field name and followed by the rp_* columns.
+    """
+    item_type = get_item_type(model.__fields__[field_name].annotation)
+    if is_model(item_type):
+        fields = [
+            pa.field(f"{field_name}_{name}", get_arrow_type(field.annotation))
+            for name, field in item_type.__fields__.items()
+        ]
+    else:
+        fields = [pa.field(field_name, get_arrow_type(model.__fields__[field_name].annotation))]
+
+    return pa.schema(fields + get_rp_id_type_schema(model))
+
+
+def get_one_level_schema(model: Type[BaseModel], nested_fields: List[str]) -> pa.Schema:
+    """
+    Get the schema of the <collection>_one_level_data.parquet file.
+    """
+    return pa.schema(
+        [
+            pa.field(field_name, get_arrow_type(field.annotation))
+            for field_name, field in model.__fields__.items()
+            if field_name not in nested_fields
+        ]
+    )
@@ -0,0 +1,132 @@
+import hashlib
+import json
+import os
+from logging import getLogger
+from typing import Dict, Iterable
+
+from dump_analyzer.data_loader.inventory import PartFile
+from dump_analyzer.settings import settings
+
+logger = getLogger(__name__)
+
+MANIFEST_FILE = "manifest.jsonl"
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def get_file_state(part_file: PartFile) -> Dict:
+    """
+    Get the state of a part file used to detect whether it changed since it was processed.
+    Parameters:
+        part_file (PartFile): The part file, as found by scan_part_files.
+    Returns:
+        Dict: Size and modification time of the file, or size and SHA-1 of its content
+        if settings.CHECKPOINT_HASH is set.
+    """
+    if not settings.CHECKPOINT_HASH:
+        return {"size": part_file.size, "mtime": part_file.mtime}
+
+    sha1 = hashlib.sha1()
+    with open(part_file.path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            sha1.update(chunk)
+    return {"size": part_file.size, "sha1": sha1.hexdigest()}
+
+
+class Manifest:
+    """
+    Record of the part files of a collection that were already processed.
+
+    Each processed part file is appended as one JSON line holding its state and the
+    partial outputs it produced, so the manifest stays valid if the run is killed.
+    The first line holds a fingerprint of the output schemas and settings; partial
+    outputs recorded under another fingerprint are not reused.
+    """
+
+    def __init__(self, checkpoint_path: str, fingerprint: str):
+        self.checkpoint_path = checkpoint_path
+        self.fingerprint = fingerprint
+        self.path = os.path.join(checkpoint_path, MANIFEST_FILE)
+        self.entries: Dict[str, Dict] = {}
+
+        os.makedirs(checkpoint_path, exist_ok=True)
+        self._load()
+        self.compact()
+
+    def _load(self) -> None:
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "r") as f:
+            header = f.readline()
+            if not header or json.loads(header).get("fingerprint") != self.fingerprint:
+                logger.info(f"Output schema changed, partial outputs in {self.checkpoint_path} are not reused")
+                return
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # The last line is incomplete if a run was killed while writing it
+                    continue
+                self.entries[entry["part"]] = entry
+
+    def compact(self) -> None:
+        """
+        Rewrite the manifest with a single line per part file.
+        """
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(json.dumps({"fingerprint": self.fingerprint}) + "\n")
+            for entry in self.entries.values():
+                f.write(json.dumps(entry) + "\n")
+        os.replace(tmp_path, self.path)
+
+    def is_processed(self, part_name: str, state: Dict) -> bool:
+        """
+        Check whether a part file in the given state was processed and its partial outputs still exist.
+        """
+        entry = self.entries.get(part_name)
+        return (
+            entry is not None
+            and entry["state"] == state
+            and all(os.path.exists(path) for path in self.get_outputs(part_name).values())
+        )
+
+    def get_outputs(self, part_name: str) -> Dict[str, str]:
+        """
+        Get paths of the partial outputs of a part file keyed by field name.
+        """
+        entry = self.entries.get(part_name)
+        if entry is None:
+            return {}
+        return {
+            field_name: os.path.join(self.checkpoint_path, output)
+            for field_name, output in entry["outputs"].items()
+        }
+
+    def add(self, part_name: str, state: Dict, outputs: Dict[str, str]) -> None:
+        """
+        Record a processed part file with its partial outputs.
+        """
+        entry = {
+            "part": part_name,
+            "state": state,
+            "dump": settings.DUMP_YYYYMM,
+            "outputs": {
+                field_name: os.path.relpath(path, self.checkpoint_path)
+                for field_name, path in outputs.items()
+            },
+        }
+        self.entries[part_name] = entry
+        with open(self.path, "a") as f:
+            f.write(json.dumps(entry) + "\n")
+
+    def remove_missing(self, part_names: Iterable[str]) -> None:
+        """
+        Forget part files which are not in the input anymore and delete their partial outputs.
+        """
+        part_names = set(part_names)
+        for part_name in [part for part in self.entries if part not in part_names]:
+            for path in self.get_outputs(part_name).values():
+                if os.path.exists(path):
+                    os.remove(path)
+            del self.entries[part_name]
+        self.compact()
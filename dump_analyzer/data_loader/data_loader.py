@@ -1,16 +1,35 @@
+import hashlib
 import json
 import os
-import inspect
-import pandas as pd
-from enum import Enum
+import pyarrow as pa
+import pyarrow.parquet as pq
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from logging import getLogger
 from pydantic import BaseModel
 from typing import Dict, Generator, List, Type
 from tqdm import tqdm
+from dump_analyzer.data_loader.arrow_schema import get_nested_field_schema, get_one_level_schema
+from dump_analyzer.data_loader.checkpoint import Manifest, get_file_state
+from dump_analyzer.data_loader.flattener import get_alias_converter, get_flattener
+from dump_analyzer.data_loader.inventory import scan_part_files
+from dump_analyzer.data_loader.parquet_writer import (
+    CONVERSION_BATCH_ROWS,
+    ParquetFieldWriter,
+    RecordWriters,
+)
 from dump_analyzer.settings import settings
 
 logger = getLogger(__name__)
 
+try:
+    import orjson
+
+    json_loads = orjson.loads
+except ImportError:  # orjson is optional, fall back to the standard library decoder
+    json_loads = json.loads
+
+ONE_LEVEL_DATA = "one_level_data"
+
 
 def normalize_directory_name(directory_name: str) -> str:
     """
@@ -29,121 +48,182 @@ def normalize_directory_name(directory_name: str) -> str:
 
 def process_file(
     file_path: str, model: Type[BaseModel]
-) -> Generator[BaseModel, None, None]:
-    with open(file_path, "r") as f:
-        for line in f:
+) -> Generator[Dict, None, None]:
+    """
+    Decode each line of a part file into a dict keyed by the model field names.
+    Depending on settings.VALIDATION, every line ("full"), every VALIDATION_SAMPLE_STEP-th line
+    ("sampled") or no line ("off") is validated with model.parse_obj. Lines which are not
+    validated are flattened straight from the decoded JSON. Invalid lines are logged and skipped.
+    """
+    alias_converter = get_alias_converter(model)
+    with open(file_path, "rb") as f:
+        for line_number, line in enumerate(f):
             try:
-                data = json.loads(line)
-                yield model.parse_obj(data)
+                data = json_loads(line)
+                if settings.VALIDATION == "full" or (
+                    settings.VALIDATION == "sampled"
+                    and line_number % settings.VALIDATION_SAMPLE_STEP == 0
+                ):
+                    rp = model.parse_obj(data).dict()
+                elif not isinstance(data, dict):
+                    raise ValueError(f"Expected a JSON object, got {type(data).__name__}")
+                else:
+                    rp = alias_converter(data) if alias_converter else data
             except Exception as e:
                 logger.error(f"Error parsing item in {file_path=}: {e}\n{line=}")
+                continue
+            yield rp
 
 
-def convert_model_to_dict(value, parent_key=None) -> dict:
+def get_field_schemas(model: Type[BaseModel]) -> Dict[str, pa.Schema]:
     """
-    Convert a value to a dictionary, handling Enums, lists, and Pydantic models.
+    Get the schemas of the saved Parquet files keyed by field name.
     """
-    if isinstance(value, BaseModel):
-        return {
-            f"{parent_key}_{k}" if parent_key else k: convert_model_to_dict(v, k)
-            for k, v in value.dict().items()
-        }
-    elif isinstance(value, Enum):
-        return value.value
-    elif isinstance(value, list):
-        return [convert_model_to_dict(item, parent_key) for item in value]
-    else:
-        return value
+    schemas = {
+        field_name: get_nested_field_schema(model, field_name)
+        for field_name in model.__fields__
+        if field_name in settings.NESTED_FIELDS_LIST
+    }
+    schemas[ONE_LEVEL_DATA] = get_one_level_schema(model, settings.NESTED_FIELDS_LIST)
+    return schemas
 
 
-def process_and_save_data(path: str, model: Type[BaseModel]) -> None:
+def process_part_file(
+    file_path: str, model: Type[BaseModel], checkpoint_path: str, part_name: str
+) -> Dict[str, str]:
+    """
+    Flatten a single part file and stream its rows into partial Parquet files, one per field.
+    Parameters:
+        file_path (str): The .json part file to process.
+        model (Type[BaseModel]): The model used to parse each line of the part file.
+        checkpoint_path (str): The checkpoint directory where partial outputs are written.
+        part_name (str): The name of the part file used to name its partial outputs.
+    Returns:
+        Dict[str, str]: Paths of the saved partial outputs keyed by field name.
+    """
+    writers = {}
+    for field_name, schema in get_field_schemas(model).items():
+        field_path = os.path.join(checkpoint_path, field_name)
+        os.makedirs(field_path, exist_ok=True)
+        writers[field_name] = ParquetFieldWriter(
+            os.path.join(field_path, f"{part_name}.parquet"), schema, by_record=True
+        )
+
+    flattener = get_flattener(model, tuple(settings.NESTED_FIELDS_LIST), ONE_LEVEL_DATA)
+    with RecordWriters(writers) as record_writers:
+        for rp in process_file(file_path, model):
+            flattener.flatten(rp, writers)
+            record_writers.end_record()
+    if record_writers.invalid_records:
+        logger.error(f"Skipped {record_writers.invalid_records} records not matching the schema in {file_path=}")
+
+    partial_outputs = {}
+    for field_name, writer in writers.items():
+        if writer.rows_written:
+            partial_outputs[field_name] = writer.path
+        elif os.path.exists(writer.path):
+            # Left by a previous version of the part file
+            os.remove(writer.path)
+    return partial_outputs
+
+
+def merge_partial_outputs(
+    partial_outputs: List[Dict[str, str]], model: Type[BaseModel], metadata_path: str, collection: str
+) -> None:
+    """
+    Merge partial outputs of all part files into the <collection>_<field>.parquet files.
+    Partial outputs are streamed batch by batch in the order of the given list.
+    """
+    for field_name, schema in tqdm(get_field_schemas(model).items(), desc="Saving DataFrames"):
+        paths = [outputs[field_name] for outputs in partial_outputs if field_name in outputs]
+        output_path = os.path.join(metadata_path, f"{collection}_{field_name}.parquet")
 
-    settings_collection = os.path.basename(path.rstrip(os.sep))
+        with ParquetFieldWriter(output_path, schema) as writer:
+            for partial_output in paths:
+                for batch in pq.ParquetFile(partial_output).iter_batches(
+                    batch_size=CONVERSION_BATCH_ROWS
+                ):
+                    writer.write_batch(batch)
 
-    files_generator = (
-        os.path.join(root, file_name)
-        for root, _, files in os.walk(path)
-        for file_name in files
-        if file_name.endswith(".json")
-    )
+        if not writer.rows_written and field_name == ONE_LEVEL_DATA:
+            pq.write_table(schema.empty_table(), output_path)
 
-    total_files = sum(1 for _ in files_generator)
 
-    files_generator = (
-        os.path.join(root, file_name)
-        for root, _, files in os.walk(path)
-        for file_name in files
-        if file_name.endswith(".json")
-    )
+def get_checkpoint_fingerprint(model: Type[BaseModel]) -> str:
+    """
+    Get a fingerprint of everything, besides the part file itself, that partial outputs depend on.
+    """
+    schemas = {field_name: str(schema) for field_name, schema in get_field_schemas(model).items()}
+    return hashlib.sha1(
+        json.dumps({"schemas": schemas, "validation": settings.VALIDATION}).encode()
+    ).hexdigest()
 
-    dataframes: Dict[str, List] = {
-        field_name: []
-        for field_name in model.__fields__
-        if field_name in settings.NESTED_FIELDS_LIST
-    }
-    one_lvl_data: Dict[str, List] = {
-        field_name: []
-        for field_name in model.__fields__
-        if field_name not in settings.NESTED_FIELDS_LIST
-    }
 
-    for file_path in tqdm(files_generator, total=total_files, desc="Processing Files"):
-        for rp in process_file(file_path, model):
-            rp_id_type_data = {
-                "rp_id": rp.id,
-                "rp_type": rp.type,
-                "rp_publisher": rp.publisher,
-            }
-            for field_name, field_type in model.__fields__.items():
-                field_data = getattr(rp, field_name, None)
-                if field_name in settings.NESTED_FIELDS_LIST:
-                    converted_field_data = convert_model_to_dict(field_data, parent_key=field_name)
-                else:
-                    converted_field_data = convert_model_to_dict(field_data)
-
-                if field_name in settings.NESTED_FIELDS_LIST:
-                    if converted_field_data:
-                        if isinstance(converted_field_data, list):
-                            for item in converted_field_data:
-                                if isinstance(item, dict):
-                                    item.update(rp_id_type_data)
-                            dataframes[field_name].extend(converted_field_data)
-                        elif isinstance(converted_field_data, dict):
-                            converted_field_data.update(rp_id_type_data)
-                            dataframes[field_name].append(converted_field_data)
-                        else:
-                            single_field_data = {field_name: converted_field_data}
-                            single_field_data.update(rp_id_type_data)
-                            dataframes[field_name].append(single_field_data)
-                    else:
-                        if inspect.isclass(field_type) and issubclass(field_type, BaseModel):
-                            empty_data = {nested_field: None for nested_field in field_type.__fields__}
-                            empty_data.update(rp_id_type_data)
-                            dataframes[field_name].append(empty_data)
-                        else:
-                            # For fields that are not Pydantic models, just append rp_id_type_data
-                            dataframes[field_name].append(rp_id_type_data)
-                else:
-                    if isinstance(converted_field_data, dict):
-                        converted_field_data.update(rp_id_type_data)
-                    one_lvl_data[field_name].append(converted_field_data)
-
-    for field_name, data in tqdm(dataframes.items(), desc="Saving DataFrames"):
-        if data:
-            df = pd.DataFrame(data)
-            df.to_parquet(
-                os.path.join(
-                    settings.COLLECTIONS[normalize_directory_name(settings_collection)]['METADATA'],
-                    f"{normalize_directory_name(settings_collection)}_{field_name}.parquet",
-                ),
-                index=False,
-            )
-
-    one_lvl_df = pd.DataFrame(one_lvl_data)
-    one_lvl_df.to_parquet(
-        os.path.join(
-            settings.COLLECTIONS[normalize_directory_name(settings_collection)]['METADATA'],
-            f"{normalize_directory_name(settings_collection)}_one_level_data.parquet",
-        ),
-        index=False,
+def process_and_save_data(path: str, model: Type[BaseModel]) -> None:
+    """
+    Process all .json part files of a collection and save them as <collection>_<field>.parquet files.
+    Part files are shared out across settings.WORKERS processes, each writing its own partial
+    outputs into settings.CHECKPOINT_PATH, which are merged once all part files are processed.
+    Part files recorded in the checkpoint manifest as processed, and unchanged since, are skipped.
+    The input tree is scanned once; progress is reported in bytes and workers take the largest
+    part files first.
+    """
+    settings_collection = normalize_directory_name(os.path.basename(path.rstrip(os.sep)))
+    metadata_path = settings.COLLECTIONS[settings_collection]["METADATA"]
+    checkpoint_path = os.path.join(settings.CHECKPOINT_PATH, settings_collection)
+    manifest = Manifest(checkpoint_path, get_checkpoint_fingerprint(model))
+
+    part_files = scan_part_files(path)
+    manifest.remove_missing(part_file.name for part_file in part_files)
+
+    with tqdm(
+        total=sum(part_file.size for part_file in part_files),
+        desc="Processing Files",
+        unit="B",
+        unit_scale=True,
+        unit_divisor=1024,
+    ) as pbar:
+        if settings.WORKERS > 1:
+            with ProcessPoolExecutor(max_workers=settings.WORKERS) as executor:
+                states = dict(zip(part_files, executor.map(get_file_state, part_files)))
+                # Largest files go first, so workers are not left waiting for a single big one
+                futures = {
+                    executor.submit(
+                        process_part_file, part_file.path, model, checkpoint_path, part_file.name
+                    ): (part_file, states[part_file])
+                    for part_file in sorted(part_files, key=lambda part_file: -part_file.size)
+                    if not manifest.is_processed(part_file.name, states[part_file])
+                }
+                pbar.update(pbar.total - sum(part_file.size for part_file, _ in futures.values()))
+                # Every processed part file is recorded, so a failed one does not lose the others
+                failed_parts = []
+                for future in as_completed(futures):
+                    part_file, state = futures[future]
+                    try:
+                        manifest.add(part_file.name, state, future.result())
+                    except Exception as e:
+                        logger.error(f"Error processing {part_file.path}: {e!r}")
+                        failed_parts.append(part_file.name)
+                    pbar.update(part_file.size)
+            if failed_parts:
+                raise RuntimeError(
+                    f"{len(failed_parts)} part files failed and were not processed: {failed_parts}"
+                )
+        else:
+            for part_file in part_files:
+                state = get_file_state(part_file)
+                if not manifest.is_processed(part_file.name, state):
+                    manifest.add(
+                        part_file.name,
+                        state,
+                        process_part_file(part_file.path, model, checkpoint_path, part_file.name),
+                    )
+                pbar.update(part_file.size)
+
+    manifest.compact()
+    merge_partial_outputs(
+        [manifest.get_outputs(part_file.name) for part_file in part_files],
+        model,
+        metadata_path,
+        settings_collection,
     )
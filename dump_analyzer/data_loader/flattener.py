@@ -0,0 +1,134 @@
+from functools import lru_cache
+from itertools import chain
+from pydantic import BaseModel
+from typing import Any, Callable, Dict, List, Optional, Tuple, Type, get_args, get_origin
+
+from dump_analyzer.data_loader.arrow_schema import (
+    RP_ID_TYPE_FIELDS,
+    get_item_type,
+    is_model,
+    unwrap_optional,
+)
+
+Converter = Callable[[Any], Any]
+
+
+def get_value_converter(annotation: Any) -> Optional[Converter]:
+    """
+    Build a function renaming aliased keys of decoded JSON values to model field names.
+    Parameters:
+        annotation (Any): The type annotation of a pydantic field.
+    Returns:
+        Optional[Converter]: The converter, or None if no value of this type holds an aliased field.
+    """
+    annotation = unwrap_optional(annotation)
+    origin = get_origin(annotation)
+
+    if origin in (list, List):
+        item_converter = get_value_converter(get_args(annotation)[0])
+        if item_converter is None:
+            return None
+        return lambda value: (
+            [item_converter(item) for item in value] if isinstance(value, list) else value
+        )
+    if origin in (dict, Dict):
+        item_converter = get_value_converter(get_args(annotation)[1])
+        if item_converter is None:
+            return None
+        return lambda value: (
+            {key: item_converter(item) for key, item in value.items()}
+            if isinstance(value, dict)
+            else value
+        )
+    if is_model(annotation):
+        return get_alias_converter(annotation)
+    return None
+
+
+@lru_cache(maxsize=None)
+def get_alias_converter(model: Type[BaseModel]) -> Optional[Converter]:
+    """
+    Build a function renaming, in place, aliased keys of a decoded JSON object of the given model,
+    the way model.parse_obj(data).dict() does. Only the fields that are aliased, or hold
+    aliased fields, are visited.
+    """
+    renames = []
+    for field_name, field in model.__fields__.items():
+        key = field.alias or field_name
+        converter = get_value_converter(field.annotation)
+        if key != field_name or converter is not None:
+            renames.append((key, field_name, converter))
+
+    if not renames:
+        return None
+
+    def convert(data: Any) -> Any:
+        if not isinstance(data, dict):
+            return data
+        for key, field_name, converter in renames:
+            if key in data:
+                value = data.pop(key)
+                data[field_name] = value if converter is None or value is None else converter(value)
+        return data
+
+    return convert
+
+
+class ModelFlattener:
+    """
+    Flattener of decoded records of a model into the rows of the saved Parquet files.
+
+    The columns of every field are planned once from the model __fields__ tree: nested
+    fields holding models (ResearchProduct.instance, .author, .indicator, ...) get one
+    column per field of the nested model, followed by the rp_* columns, the other nested
+    fields a single column, and the remaining fields go to the one level data. Flattening
+    a record is then a lookup of the planned keys, in the column order of the schemas
+    built by arrow_schema, with values passed straight to the columns of the writers.
+    """
+
+    def __init__(self, model: Type[BaseModel], nested_fields: Tuple[str, ...], one_level_data: str):
+        self.one_level_data = one_level_data
+        self.one_level_fields = [
+            field_name for field_name in model.__fields__ if field_name not in nested_fields
+        ]
+        self.rp_id_type_fields = list(RP_ID_TYPE_FIELDS.values())
+        self.nested_fields = []
+        for field_name, field in model.__fields__.items():
+            if field_name not in nested_fields:
+                continue
+            item_type = get_item_type(field.annotation)
+            keys = list(item_type.__fields__) if is_model(item_type) else None
+            empty_values = (None,) * (len(keys) if keys else 1)
+            self.nested_fields.append((field_name, keys, empty_values))
+
+    def flatten(self, rp: Dict, writers: Dict[str, Any]) -> None:
+        """
+        Flatten a single record into rows written by the per-field writers.
+        """
+        rp_id_type_data = tuple(map(rp.get, self.rp_id_type_fields))
+
+        for field_name, keys, empty_values in self.nested_fields:
+            field_data = rp.get(field_name)
+            writer = writers[field_name]
+            if not field_data:
+                writer.write_row(empty_values + rp_id_type_data)
+            elif keys is None:
+                writer.write_row((field_data,) + rp_id_type_data)
+            else:
+                for item in field_data if isinstance(field_data, list) else (field_data,):
+                    if not isinstance(item, dict):
+                        # Only possible for records which were not validated
+                        continue
+                    writer.write_row(chain(map(item.get, keys), rp_id_type_data))
+
+        writers[self.one_level_data].write_row(map(rp.get, self.one_level_fields))
+
+
+@lru_cache(maxsize=None)
+def get_flattener(
+    model: Type[BaseModel], nested_fields: Tuple[str, ...], one_level_data: str
+) -> ModelFlattener:
+    """
+    Get the flattener of a model, built once per model class.
+    """
+    return ModelFlattener(model, nested_fields, one_level_data)
@@ -0,0 +1,49 @@
+import os
+from typing import List, NamedTuple
+
+
+class PartFile(NamedTuple):
+    path: str
+    name: str
+    size: int
+    mtime: int
+
+
+def get_part_name(path: str, file_path: str) -> str:
+    """
+    Get a name identifying a part file within its collection, used to name its partial outputs.
+    Parameters:
+        path (str): The collection input directory.
+        file_path (str): The part file path.
+    Returns:
+        str: The part file path relative to the collection, without extension and separators.
+    """
+    return os.path.splitext(os.path.relpath(file_path, path))[0].replace(os.sep, "__")
+
+
+def scan_part_files(path: str) -> List[PartFile]:
+    """
+    List the .json part files of a collection with their sizes in a single scan of the directory tree.
+    Parameters:
+        path (str): The collection input directory.
+    Returns:
+        List[PartFile]: The part files sorted by path.
+    """
+    part_files = []
+    directories = [path]
+    while directories:
+        with os.scandir(directories.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    directories.append(entry.path)
+                elif entry.name.endswith(".json"):
+                    stat = entry.stat()
+                    part_files.append(
+                        PartFile(
+                            entry.path,
+                            get_part_name(path, entry.path),
+                            stat.st_size,
+                            stat.st_mtime_ns,
+                        )
+                    )
+    return sorted(part_files)
@@ -0,0 +1,336 @@
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+from logging import getLogger
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+from dump_analyzer.settings import settings
+
+logger = getLogger(__name__)
+
+# Number of buffered rows converted into a single Arrow record batch
+CONVERSION_BATCH_ROWS = 1024
+
+
+class ColumnBuffer:
+    """
+    Values of a single column buffered until they are converted into an Arrow array.
+    """
+
+    def __init__(self, data_type: pa.DataType):
+        self.data_type = data_type
+        self.values: List[Any] = []
+
+    def append(self, value: Any) -> None:
+        self.values.append(value)
+
+    def to_array(self) -> pa.Array:
+        return pa.array(self.values, type=self.data_type)
+
+    def find_invalid_rows(self) -> Set[int]:
+        """
+        Get the indices of values which cannot be converted to the type of the column.
+        """
+        invalid_rows = set()
+        for index, value in enumerate(self.values):
+            try:
+                pa.array([value], type=self.data_type)
+            except (pa.ArrowException, OverflowError) as e:
+                logger.error(f"Value not matching the column type {self.data_type}: {e}\n{value=}")
+                invalid_rows.add(index)
+        return invalid_rows
+
+    def drop_rows(self, rows: Set[int]) -> None:
+        self.values[:] = [value for index, value in enumerate(self.values) if index not in rows]
+
+    def clear(self) -> None:
+        self.values.clear()
+
+
+class ListColumnBuffer(ColumnBuffer):
+    """
+    Values of a list column. pa.array would convert a string into the list of its characters,
+    so values which are not lists are rejected as not matching the type of the column.
+    """
+
+    def to_array(self) -> pa.Array:
+        if not all(value is None or isinstance(value, (list, tuple)) for value in self.values):
+            raise pa.ArrowTypeError(f"Expected lists for the column type {self.data_type}")
+        return super().to_array()
+
+    def find_invalid_rows(self) -> Set[int]:
+        invalid_rows = set()
+        for index, value in enumerate(self.values):
+            if value is not None and not isinstance(value, (list, tuple)):
+                logger.error(f"Value not matching the column type {self.data_type}: {value=}")
+                invalid_rows.add(index)
+        return invalid_rows | super().find_invalid_rows()
+
+
+class DictionaryColumnBuffer(ColumnBuffer):
+    """
+    Values of a dictionary-encoded column, buffered as indices into the distinct values seen
+    since the last conversion. Used for the rp_* columns repeated on every row of a record.
+    """
+
+    def __init__(self, data_type: pa.DictionaryType):
+        super().__init__(data_type)
+        self.dictionary: Dict[Any, int] = {}
+
+    def append(self, value: Any) -> None:
+        if value is None:
+            self.values.append(None)
+            return
+        try:
+            self.values.append(self.dictionary.setdefault(value, len(self.dictionary)))
+        except TypeError as e:
+            # Only possible for records which were not validated
+            logger.error(f"Value not matching the column type {self.data_type}: {e}\n{value=}")
+            self.values.append(None)
+
+    def to_array(self) -> pa.Array:
+        return pa.DictionaryArray.from_arrays(
+            pa.array(self.values, type=self.data_type.index_type),
+            pa.array(list(self.dictionary), type=self.data_type.value_type),
+        )
+
+    def find_invalid_rows(self) -> Set[int]:
+        invalid_indices = set()
+        for value, index in self.dictionary.items():
+            try:
+                pa.array([value], type=self.data_type.value_type)
+            except (pa.ArrowException, OverflowError) as e:
+                logger.error(f"Value not matching the column type {self.data_type}: {e}\n{value=}")
+                invalid_indices.add(index)
+        return {row for row, index in enumerate(self.values) if index in invalid_indices}
+
+    def drop_rows(self, rows: Set[int]) -> None:
+        dictionary = list(self.dictionary)
+        values = [
+            None if index is None else dictionary[index]
+            for row, index in enumerate(self.values)
+            if row not in rows
+        ]
+        self.clear()
+        for value in values:
+            self.append(value)
+
+    def clear(self) -> None:
+        super().clear()
+        self.dictionary.clear()
+
+
+class ParquetFieldWriter:
+    """
+    Streaming writer of the rows of a single field into a Parquet file.
+
+    Rows are buffered column by column, dictionary-encoded columns as indices, and every
+    CONVERSION_BATCH_ROWS rows they are converted into an Arrow record batch. A row group
+    is written once the converted batches reach row_group_rows rows or row_group_bytes
+    bytes, so the memory used by the writer does not depend on the number of rows written.
+    Writers of a RecordWriters group are fed record by record and their rows are converted
+    by the group instead.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        schema: pa.Schema,
+        row_group_rows: Optional[int] = None,
+        row_group_bytes: Optional[int] = None,
+        by_record: bool = False,
+    ):
+        self.path = path
+        self.by_record = by_record
+        self.schema = schema
+        self.row_group_rows = row_group_rows or settings.ROW_GROUP_ROWS
+        self.row_group_bytes = row_group_bytes or settings.ROW_GROUP_BYTES
+        self.rows_written = 0
+
+        self._columns: List[ColumnBuffer] = [
+            DictionaryColumnBuffer(field.type)
+            if pa.types.is_dictionary(field.type)
+            else ListColumnBuffer(field.type)
+            if pa.types.is_list(field.type) or pa.types.is_large_list(field.type)
+            else ColumnBuffer(field.type)
+            for field in schema
+        ]
+        self._appends = [column.append for column in self._columns]
+        self._rows = 0
+        # Number of buffered rows at the end of each record, for writers fed record by record
+        self._record_ends: List[int] = []
+        self._batches: List[pa.RecordBatch] = []
+        self._buffered_rows = 0
+        self._buffered_bytes = 0
+        self._writer: Optional[pq.ParquetWriter] = None
+
+    def __enter__(self) -> "ParquetFieldWriter":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
+
+    def write_row(self, values: Iterable[Any]) -> None:
+        """
+        Write a single row given as the values of all columns, in the order of the schema.
+        """
+        for append, value in zip(self._appends, values):
+            append(value)
+        self._rows += 1
+        if self._rows >= CONVERSION_BATCH_ROWS and not self.by_record:
+            self._convert_rows()
+
+    @property
+    def buffered_rows(self) -> int:
+        """
+        Number of rows written and not converted yet.
+        """
+        return self._rows
+
+    def end_record(self) -> None:
+        """
+        Mark the rows written so far as the rows of a complete record.
+        """
+        self._record_ends.append(self._rows)
+
+    def write_batch(self, batch: pa.RecordBatch) -> None:
+        """
+        Write an Arrow record batch that already follows the schema of the writer.
+        """
+        self._convert_rows()
+        self._buffer_batch(batch)
+
+    def _convert_rows(self) -> None:
+        if not self._rows:
+            return
+        batch, _ = self._rows_to_batch()
+        self._buffer_batch(batch)
+
+    def _rows_to_batch(self) -> Tuple[pa.RecordBatch, Set[int]]:
+        """
+        Convert the buffered rows into a record batch, skipping the rows not matching the schema.
+        Returns the batch and the indices of the skipped rows.
+        """
+        try:
+            arrays = [column.to_array() for column in self._columns]
+            invalid_rows = set()
+        except (pa.ArrowException, OverflowError):
+            # Rows which were not validated may not match the schema, only those are skipped
+            invalid_rows = set().union(*(column.find_invalid_rows() for column in self._columns))
+            logger.error(f"Skipping {len(invalid_rows)} rows not matching the schema of {self.path}")
+            for column in self._columns:
+                column.drop_rows(invalid_rows)
+            arrays = [column.to_array() for column in self._columns]
+
+        for column in self._columns:
+            column.clear()
+        self._rows = 0
+        return pa.RecordBatch.from_arrays(arrays, schema=self.schema), invalid_rows
+
+    def convert_records(self) -> Tuple[pa.RecordBatch, np.ndarray, Set[int]]:
+        """
+        Convert the rows of the complete records, for writers fed record by record.
+        Returns the batch, the record of each of its rows and the records with skipped rows,
+        records being numbered from 0 since the last conversion.
+        """
+        record_ends = np.array(self._record_ends, dtype=np.int64)
+        row_records = np.searchsorted(record_ends, np.arange(self._rows), side="right")
+        batch, invalid_rows = self._rows_to_batch()
+        self._record_ends = []
+        invalid_rows = sorted(invalid_rows)
+        invalid_records = set(row_records[invalid_rows].tolist())
+        return batch, np.delete(row_records, invalid_rows), invalid_records
+
+    def _buffer_batch(self, batch: pa.RecordBatch) -> None:
+        self._batches.append(batch)
+        self._buffered_rows += batch.num_rows
+        self._buffered_bytes += batch.nbytes
+        if (
+            self._buffered_rows >= self.row_group_rows
+            or self._buffered_bytes >= self.row_group_bytes
+        ):
+            self.flush()
+
+    def flush(self) -> None:
+        """
+        Write all buffered rows as a single row group.
+        """
+        self._convert_rows()
+        if not self._buffered_rows:
+            return
+
+        if self._writer is None:
+            self._writer = pq.ParquetWriter(self.path, self.schema)
+        table = pa.Table.from_batches(self._batches, schema=self.schema)
+        self._writer.write_table(table, row_group_size=table.num_rows)
+
+        self.rows_written += self._buffered_rows
+        self._batches = []
+        self._buffered_rows = 0
+        self._buffered_bytes = 0
+
+    def close(self) -> None:
+        """
+        Flush the remaining rows and close the file. No file is created if no rows were written.
+        """
+        self.flush()
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+
+class RecordWriters:
+    """
+    Writers of all fields of a model, fed record by record.
+
+    The rows of all writers are converted together once a writer buffers CONVERSION_BATCH_ROWS
+    rows, so a record with a row not matching the schema of one field, only possible for
+    records which were not validated, is dropped from every field and the saved Parquet
+    files still join on the rp_* columns.
+    """
+
+    def __init__(self, writers: Dict[str, ParquetFieldWriter]):
+        self.writers = writers
+        self.invalid_records = 0
+
+    def __enter__(self) -> "RecordWriters":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
+
+    def end_record(self) -> None:
+        """
+        Mark the rows written so far by all writers as the rows of a complete record.
+        """
+        for writer in self.writers.values():
+            writer.end_record()
+        if any(writer.buffered_rows >= CONVERSION_BATCH_ROWS for writer in self.writers.values()):
+            self.convert()
+
+    def convert(self) -> None:
+        """
+        Convert the rows of the complete records of all writers, dropping the invalid records.
+        """
+        converted = {name: writer.convert_records() for name, writer in self.writers.items()}
+        invalid_records = set().union(*(records for _, _, records in converted.values()))
+        if invalid_records:
+            logger.error(f"Skipping {len(invalid_records)} records not matching the schema of all fields")
+            self.invalid_records += len(invalid_records)
+        invalid_records = np.array(sorted(invalid_records), dtype=np.int64)
+
+        for name, (batch, row_records, _) in converted.items():
+            if len(invalid_records):
+                batch = batch.filter(pa.array(~np.isin(row_records, invalid_records)))
+            if batch.num_rows:
+                self.writers[name].write_batch(batch)
+
+    def close(self) -> None:
+        """
+        Convert the remaining records and close all writers.
+        """
+        try:
+            self.convert()
+        finally:
+            for writer in self.writers.values():
+                writer.close()
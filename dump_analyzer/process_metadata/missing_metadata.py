@@ -1,12 +1,86 @@
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from typing import List
 
 from dump_analyzer.settings import settings
 
+try:
+    import duckdb
+except ImportError:  # duckdb is optional, only needed with METADATA_ENGINE=duckdb
+    duckdb = None
+
+
+def get_empty_values_mask(column: pd.Series) -> pd.Series:
+    """
+    Mark values of length zero, e.g. empty strings and lists, in a column.
+    Values without a length are never empty.
+
+    Args:
+        column (pd.Series): The column to check.
+
+    Returns:
+        pd.Series: Boolean mask of the empty values.
+    """
+    if isinstance(column.dtype, pd.CategoricalDtype):
+        empty_categories = np.append(column.cat.categories.astype(str).str.len() == 0, False)
+        return pd.Series(empty_categories[column.cat.codes], index=column.index)
+    if not (pd.api.types.is_object_dtype(column) or pd.api.types.is_string_dtype(column)):
+        return pd.Series(False, index=column.index)
+    try:
+        lengths = column.str.len()
+    except AttributeError:
+        # Columns whose values are neither strings nor sequences
+        lengths = column.map(lambda x: len(x) if hasattr(x, '__len__') else 1)
+    return lengths.eq(0)
+
+
+def get_id_column(file: str) -> str:
+    """
+    Get the column identifying the entity of each row of a metadata file.
+    """
+    if 'one_level_data.parquet' in file:
+        return "id"
+    return "rp_id"
+
+
+def build_missing_data_df(file: str, column_names: List[str], total_count: int, missing_counts) -> pd.DataFrame:
+    """
+    Build the missing values statistics of a file from the per-column missing entity counts.
+
+    Args:
+        file (string): The file name to add more context into df
+        column_names (List[str]): The analyzed columns.
+        total_count (int): The number of distinct entities in the file.
+        missing_counts: The number of entities missing a value, for each column.
+
+    Returns:
+        pd.DataFrame: A DataFrame containing information about missing values.
+    """
+    missing_counts = pd.Series(np.asarray(missing_counts, dtype=np.int64))
+
+    return pd.DataFrame(
+        {
+            "file_name": file,
+            "yyyymm": settings.DUMP_YYYYMM,
+            "column_name": column_names,
+            "total_count": total_count,
+            "existing_count": total_count - missing_counts,
+            "missing_count": missing_counts,
+            "missing_percentage": missing_counts / total_count * 100,
+        }
+    )
+
 
 def analyze_missing_values(df, file) -> pd.DataFrame:
     """
     Analyze missing values in each column of a DataFrame
 
+    A value is missing if it is null or empty. Counts are given in distinct entities, an entity
+    missing a value if any of its rows does. All columns are counted in a single grouped pass.
+
     Args:
         df (pd.DataFrame): The DataFrame to analyze.
         file (string): The file name to add more context into df
@@ -14,56 +88,164 @@ def analyze_missing_values(df, file) -> pd.DataFrame:
     Returns:
         pd.DataFrame: A DataFrame containing information about missing values.
     """
-    column_names = []
-    total_counts = []
-    existing_counts = []
-    missing_counts = []
-    missing_percentages = []
+    ids = df[get_id_column(file)]
+    total_count = ids.nunique()
 
-    for col in df.columns:
+    missing_mask = df.isna() | pd.DataFrame(
+        {col: get_empty_values_mask(df[col]) for col in df.columns}, index=df.index
+    )
+    missing_counts = missing_mask.groupby(ids, observed=True, sort=False).any().sum()
 
-        if 'one_level_data.parquet' in file:
-            id_col = "id"
-        else:
-            id_col = "rp_id"
+    return build_missing_data_df(file, list(df.columns), total_count, missing_counts.values)
 
-        column_names.append(col)
 
-        total_count = df[id_col].nunique()
-        total_counts.append(total_count)
+def get_arrow_empty_values_mask(column: pa.Array) -> pa.Array:
+    """
+    Mark values of length zero in an Arrow array, the same way get_empty_values_mask
+    does for the column converted to pandas.
 
-        none_count = df[id_col][df[col].isna()].nunique()
-        none_ids_set = set(df[id_col][df[col].isna()])
+    Args:
+        column (pa.Array): The column to check.
 
-        filtered_df = df[~df[col].isna()]
+    Returns:
+        pa.Array: Boolean mask of the empty values, null where the value is null.
+    """
+    data_type = column.type
+    if pa.types.is_dictionary(data_type):
+        return pc.take(get_arrow_empty_values_mask(column.dictionary), column.indices)
+    if pa.types.is_string(data_type) or pa.types.is_large_string(data_type):
+        return pc.equal(pc.utf8_length(column), 0)
+    if pa.types.is_binary(data_type) or pa.types.is_large_binary(data_type):
+        return pc.equal(pc.binary_length(column), 0)
+    if pa.types.is_map(data_type):
+        entries = pa.list_(
+            pa.field("entries", pa.struct([data_type.key_field, data_type.item_field]), nullable=False)
+        )
+        return pc.equal(pc.list_value_length(column.view(entries)), 0)
+    if pa.types.is_list(data_type) or pa.types.is_large_list(data_type):
+        return pc.equal(pc.list_value_length(column), 0)
+    if pa.types.is_struct(data_type) and data_type.num_fields == 0:
+        return pa.repeat(True, len(column))
+    return pa.repeat(False, len(column))
 
-        len_zero_count = filtered_df[id_col][
-            (filtered_df[col].apply(lambda x: len(x) if hasattr(x, '__len__') else 1) == 0) &
-            (~filtered_df[id_col].isin(none_ids_set))
-            ].nunique()
 
-        missing_count = none_count + len_zero_count
-        missing_counts.append(missing_count)
+def analyze_missing_values_arrow(file_path: str, file: str) -> pd.DataFrame:
+    """
+    Analyze missing values in each column of a Parquet file without converting it to pandas.
 
-        existing_count = total_count - missing_count
-        existing_counts.append(existing_count)
+    The file is read batch by batch and the missing values of each batch are counted per entity
+    with Arrow compute functions and a single grouped pass. Rows of an entity are expected to be
+    consecutive, as they are written by the data loader, so only the last entity of a batch is
+    carried over to the next one and memory does not depend on the file size.
 
-        missing_percentage = (missing_count / total_count) * 100
-        missing_percentages.append(missing_percentage)
+    Args:
+        file_path (str): The Parquet file to analyze.
+        file (string): The file name to add more context into df
 
-    missing_data_df = pd.DataFrame(
-        {
-            "file_name": file,
-            "yyyymm": settings.DUMP_YYYYMM,
-            "column_name": column_names,
-            "total_count": total_counts,
-            "existing_count": existing_counts,
-            "missing_count": missing_counts,
-            "missing_percentage": missing_percentages,
+    Returns:
+        pd.DataFrame: A DataFrame containing information about missing values.
+    """
+    parquet_file = pq.ParquetFile(file_path)
+    column_names = parquet_file.schema_arrow.names
+    id_col = get_id_column(file)
+    aggregations = [(str(index), "any") for index in range(len(column_names))]
+
+    total_count = 0
+    missing_counts = np.zeros(len(column_names), dtype=np.int64)
+    last_id, last_flags = None, None
+
+    for batch in parquet_file.iter_batches(batch_size=settings.METADATA_BATCH_ROWS):
+        missing_masks = {
+            name: pc.or_(
+                pc.is_null(column, nan_is_null=True),
+                pc.fill_null(get_arrow_empty_values_mask(column), False),
+            )
+            for (name, _), column in zip(aggregations, batch.columns)
         }
-    )
+        grouped = (
+            pa.table({"id": batch.column(id_col), **missing_masks})
+            .group_by("id", use_threads=False)
+            .aggregate(aggregations)
+        )
+        grouped = grouped.filter(pc.is_valid(grouped["id"]))
+        if not grouped.num_rows:
+            continue
+
+        ids = grouped["id"]
+        flags = np.column_stack(
+            [grouped[f"{name}_any"].to_numpy(zero_copy_only=False) for name, _ in aggregations]
+        )
+        if last_id is not None:
+            if ids[0].as_py() == last_id:
+                flags[0] |= last_flags
+            else:
+                total_count += 1
+                missing_counts += last_flags
+
+        total_count += grouped.num_rows - 1
+        missing_counts += flags[:-1].sum(axis=0)
+        last_id, last_flags = ids[-1].as_py(), flags[-1]
+
+    if last_id is not None:
+        total_count += 1
+        missing_counts += last_flags
+
+    return build_missing_data_df(file, column_names, total_count, missing_counts)
+
+
+def get_duckdb_missing_condition(name: str, data_type: pa.DataType) -> str:
+    """
+    Get the DuckDB condition matching missing values of a column.
+    """
+    column = '"' + name.replace('"', '""') + '"'
+    if pa.types.is_dictionary(data_type):
+        data_type = data_type.value_type
+
+    if pa.types.is_string(data_type) or pa.types.is_large_string(data_type):
+        empty = f"length({column}) = 0"
+    elif pa.types.is_binary(data_type) or pa.types.is_large_binary(data_type):
+        empty = f"octet_length({column}) = 0"
+    elif pa.types.is_map(data_type):
+        empty = f"cardinality({column}) = 0"
+    elif pa.types.is_list(data_type) or pa.types.is_large_list(data_type):
+        empty = f"len({column}) = 0"
+    elif pa.types.is_floating(data_type):
+        empty = f"isnan({column})"
+    else:
+        return f"{column} IS NULL"
+    return f"{column} IS NULL OR {empty}"
+
+
+def analyze_missing_values_duckdb(file_path: str, file: str) -> pd.DataFrame:
+    """
+    Analyze missing values in each column of a Parquet file with DuckDB.
+
+    Distinct entities are counted exactly by DuckDB, which reads only the columns of the query
+    and can spill to disk, so rows of an entity do not need to be consecutive.
+
+    Args:
+        file_path (str): The Parquet file to analyze.
+        file (string): The file name to add more context into df
+
+    Returns:
+        pd.DataFrame: A DataFrame containing information about missing values.
+    """
+    if duckdb is None:
+        raise ImportError("METADATA_ENGINE is set to duckdb, but duckdb is not installed")
+
+    schema = pq.read_schema(file_path)
+    id_col = '"' + get_id_column(file).replace('"', '""') + '"'
+    counts = [f"count(DISTINCT {id_col})"] + [
+        f"count(DISTINCT {id_col}) FILTER (WHERE {get_duckdb_missing_condition(field.name, field.type)})"
+        for field in schema
+    ]
+
+    with duckdb.connect() as connection:
+        total_count, *missing_counts = connection.execute(
+            f"SELECT {', '.join(counts)} FROM read_parquet(?)", [file_path]
+        ).fetchone()
 
-    return missing_data_df
+    return build_missing_data_df(file, schema.names, total_count, missing_counts)
 
 
 def aggregate_missing_data(missing_data_df: pd.DataFrame) -> pd.DataFrame:
@@ -1,30 +1,58 @@
 import os
+from concurrent.futures import ProcessPoolExecutor
 
 import pandas as pd
 import pyarrow.parquet as pq
 from tqdm import tqdm
 
-from dump_analyzer.process_metadata.missing_metadata import analyze_missing_values, aggregate_missing_data
+from dump_analyzer.process_metadata.missing_metadata import (
+    aggregate_missing_data,
+    analyze_missing_values,
+    analyze_missing_values_arrow,
+    analyze_missing_values_duckdb,
+)
 from dump_analyzer.settings import settings
 
 
-def process_metadata(folder_path):
-    """"""
-    combined_missing_df = pd.DataFrame()
-
-    for directory in tqdm(os.listdir(folder_path), desc="Processing Directories"):
-        for file in tqdm(os.listdir(os.path.join(folder_path, directory)), desc=f"Processing Files in {directory}", leave=False):
-            if file.endswith(".parquet"):
-                file_path = os.path.join(folder_path, directory, file)
+def analyze_file(file_path: str, file: str) -> pd.DataFrame:
+    """
+    Analyze missing values of a single metadata file with the engine set in settings.METADATA_ENGINE.
+    """
+    if settings.METADATA_ENGINE == "duckdb":
+        return analyze_missing_values_duckdb(file_path, file)
+    if settings.METADATA_ENGINE == "arrow":
+        return analyze_missing_values_arrow(file_path, file)
 
-                table = pq.read_table(file_path)
+    df = pq.read_table(file_path).to_pandas()
+    return analyze_missing_values(df, file)
 
-                df = table.to_pandas()
 
-                missing_df = analyze_missing_values(df, file)
-                combined_missing_df = pd.concat(
-                    [combined_missing_df, missing_df], ignore_index=True, sort=False
-                )
+def process_metadata(folder_path):
+    """
+    Analyze missing values of all metadata files and save them with their aggregation to a CSV file.
+    Files are analyzed in parallel by settings.WORKERS processes; results are kept in the order
+    of the sorted directory and file names, so the CSV file is the same between runs.
+    """
+    file_paths, files = [], []
+    for directory in sorted(os.listdir(folder_path)):
+        for file in sorted(os.listdir(os.path.join(folder_path, directory))):
+            if file.endswith(".parquet"):
+                file_paths.append(os.path.join(folder_path, directory, file))
+                files.append(file)
+
+    if settings.WORKERS > 1:
+        with ProcessPoolExecutor(max_workers=settings.WORKERS) as executor:
+            # map yields results in the order of the files, whichever worker finishes first
+            missing_dfs = list(
+                tqdm(executor.map(analyze_file, file_paths, files), total=len(files), desc="Processing Files")
+            )
+    else:
+        missing_dfs = [
+            analyze_file(file_path, file)
+            for file_path, file in tqdm(zip(file_paths, files), total=len(files), desc="Processing Files")
+        ]
+
+    combined_missing_df = pd.concat(missing_dfs, ignore_index=True, sort=False)
 
     aggregated_data = aggregate_missing_data(combined_missing_df)
 
@@ -3,7 +3,7 @@
 import logging
 import os
 from pydantic_settings import BaseSettings, SettingsConfigDict
-from typing import List
+from typing import List, Literal
 from dump_analyzer.data_loader.schema.properties.data import (
     AFFILIATION,
     AUTHOR,
@@ -39,6 +39,8 @@ class Settings(BaseSettings):
     OTHER_RP_PATH: str = "input/other_rp"
     METADATA_PATH: str = "output/metadata"
     PROCESSED_METADATA_PATH: str = "output/processed_metadata"
+    # Partial outputs of processed part files, reused by the next runs
+    CHECKPOINT_PATH: str = "output/checkpoints"
 
     # Defined data types, "type" property of each data type
     SOFTWARE: str = "software"
@@ -48,6 +50,26 @@ class Settings(BaseSettings):
 
     DUMP_YYYYMM: str = "YYYYMM"
 
+    # Number of processes sharing out the part files of a collection
+    WORKERS: int = 1
+
+    # Limits of the row groups buffered in memory while writing Parquet files
+    ROW_GROUP_ROWS: int = 100_000
+    ROW_GROUP_BYTES: int = 64 * 1024 * 1024
+
+    # Validation of the dump lines against the model: "full", "sampled" or "off"
+    VALIDATION: Literal["off", "sampled", "full"] = "full"
+    # With "sampled" validation, every n-th line of a part file is validated
+    VALIDATION_SAMPLE_STEP: int = 100
+
+    # Detect changed part files by the hash of their content instead of their modification time
+    CHECKPOINT_HASH: bool = False
+
+    # Engine of the missing metadata analysis: "arrow", "duckdb" (optional dependency) or "pandas"
+    METADATA_ENGINE: Literal["arrow", "duckdb", "pandas"] = "arrow"
+    # Number of rows of a metadata file analyzed at once by the "arrow" engine
+    METADATA_BATCH_ROWS: int = 65_536
+
     NESTED_FIELDS_LIST: List = [
         AFFILIATION,
         AUTHOR,
@@ -2,14 +2,57 @@ AWS_ACCESS_KEY_ID = "AWS_ACCESS_KEY_ID"
 AWS_SECRET_ACCESS_KEY = "AWS_SECRET_ACCESS_KEY"
 S3_ENDPOINT = "S3_ENDPOINT"
 S3_BUCKET = "S3_BUCKET"
-URLS_BY_PUBLISHER = "input\urls_by_publisher.csv"
+URLS_BY_PUBLISHER = "input/urls_by_publisher.parquet"
 OUTPUT_PATH = "output"
 PREPROCESSED = False
 SAMPLE = 0.0025
+# Number of publishers with the most URLs sampled as strata of their own
+TOP_PUBLISHERS = 8
 SEEDS = [1]
 # ERROR_CODES = [TOO MANY REQUESTS, ERROR_CODE_TIMEOUT, ERROR_CODE_REQUEST_ERROR]
 ERROR_CODES = [429, 2.0, 3.0]
-INITIAL_SLEEP_DURATION = 300
 ERRORS_TO_KEEP_PERCENTAGE = 0.05
-THREADS = False
-MAX_WORKERS = 4
\ No newline at end of file
+# Backoff of the retries of a URL: delay before the first retry, doubled up to RETRY_MAX_DELAY seconds
+RETRY_INITIAL_DELAY = 5
+RETRY_MAX_DELAY = 300
+# Maximum number of retries of a URL after its first request
+MAX_RETRIES = 10
+# Number of S3 objects downloaded to temporary files ahead of the ones being processed
+PREFETCH_OBJECTS = 4
+# Number of processes processing the downloaded S3 objects, 0 to stream them one at a time
+PARSE_WORKERS = 4
+# Maximum number of URLs requested at once
+MAX_CONCURRENT_REQUESTS = 500
+# Maximum number of requests per second over all hosts, on top of the per-host rate limits
+RATE_LIMIT = 1000
+# Rate limit of the requests to a single host: HOST_RATE_LIMIT requests per HOST_RATE_PERIOD seconds
+HOST_RATE_LIMIT = 10
+HOST_RATE_PERIOD = 1
+# Maximum number of concurrent requests to a single host
+MAX_HOST_CONNECTIONS = 8
+# Pause of a host after a 429 response without Retry-After, doubled after each further 429
+INITIAL_BACKOFF = 1
+# Longest pause, in seconds, waited for before retrying a 429 response
+MAX_BACKOFF = 60
+# Request URLs with HEAD first, falling back to GET only if HEAD is rejected
+HEAD_FIRST = True
+# Maximum number of body bytes downloaded by GET, 0 to stop after the headers, None for the whole body
+MAX_BODY_BYTES = 0
+# SQLite cache of the responses shared by all seeds and runs, None to request every sampled URL
+RESPONSE_CACHE = "input/response_cache.sqlite"
+# Time, in seconds, a cached response is valid for
+RESPONSE_CACHE_TTL = 7 * 24 * 3600
+# Maximum number of cached responses, the oldest are removed first
+RESPONSE_CACHE_MAX_ENTRIES = 1_000_000
+# Request every URL instead of a sample, resuming the scan in SCAN_PATH if it was killed
+FULL_SCAN = False
+SCAN_PATH = "output/full_scan"
+# Number of shards the URLs are split into, and of processes scanning them at once
+SCAN_SHARDS = 256
+SCAN_WORKERS = 4
+# Maximum number of requests per second over all processes of a full scan
+SCAN_RATE_LIMIT = 1000
+# Maximum number of retries of a URL after its first request, in a full scan
+SCAN_MAX_RETRIES = 3
+# Number of response records saved at once by a shard, the most a killed scan requests again
+SCAN_PART_ROWS = 10_000
@@ -1,15 +1,46 @@
+import gzip
+import hashlib
 import json
 import logging
-from typing import List, Dict, Any
+import os
+import shutil
+import tempfile
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from typing import Dict, List, Iterable, Iterator, Optional, Tuple
 
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
 
 import boto3
 from boto3.session import Session
+from botocore.config import Config
 
 import config
 
+# Size of the chunks read from the body of an S3 object
+READ_CHUNK_SIZE = 1024 * 1024
+
+# Number of lines of an S3 object converted to a record batch at once
+PROCESS_BATCH_LINES = 10_000
+
+# Schema of the records of a processed S3 object
+OBJECT_SCHEMA = pa.schema(
+    [
+        ("id", pa.string()),
+        ("publisher", pa.dictionary(pa.int32(), pa.string())),
+        ("urls", pa.list_(pa.string())),
+        ("number_urls", pa.int64()),
+        ("number_unique_urls", pa.int64()),
+    ]
+)
+
+# Version of the urls_by_publisher cache, bumped whenever its content changes
+CACHE_VERSION = "1"
+
 
 # Configure logging
 logging.basicConfig(
@@ -27,41 +58,235 @@ def connect_to_s3(access_key: str, secret_key: str, endpoint: str) -> boto3.clie
         aws_access_key_id=access_key,
         aws_secret_access_key=secret_key,
         endpoint_url=endpoint,
+        # One pooled connection per object downloaded ahead
+        config=Config(max_pool_connections=max(config.PREFETCH_OBJECTS, 10)),
     )
 
     return s3_client
 
 
-def process_object(obj: bytes, selected_fields: List[str]) -> pd.DataFrame:
-    """Process an S3 object and return a DataFrame."""
-    rows = []
-    obj_str = obj.decode("utf-8")
-    for line in obj_str.split("\n"):
+def iter_lines(stream, chunk_size: int = READ_CHUNK_SIZE) -> Iterator[bytes]:
+    """Iterate over the lines of a binary stream, reading it chunk by chunk."""
+    pending = b""
+    for chunk in iter(lambda: stream.read(chunk_size), b""):
+        lines = (pending + chunk).split(b"\n")
+        pending = lines.pop()
+        yield from lines
+    if pending:
+        yield pending
+
+
+def iter_object_lines(s3_client: boto3.client, bucket: str, key: str) -> Iterator[bytes]:
+    """
+    Stream the lines of an S3 object, decompressing it on the fly if it is gzipped.
+
+    Only a chunk of the object is held in memory at a time.
+    """
+    body = s3_client.get_object(Bucket=bucket, Key=key)["Body"]
+    try:
+        stream = gzip.GzipFile(fileobj=body) if key.endswith(".gz") else body
+        yield from iter_lines(stream)
+    finally:
+        body.close()
+
+
+def download_object(s3_client: boto3.client, bucket: str, key: str, directory: str) -> str:
+    """
+    Download the raw, still compressed if gzipped, content of an S3 object to a temporary file
+    in directory, chunk by chunk, and return the path of the file.
+    """
+    body = s3_client.get_object(Bucket=bucket, Key=key)["Body"]
+    try:
+        with tempfile.NamedTemporaryFile(dir=directory, delete=False) as file:
+            shutil.copyfileobj(body, file, READ_CHUNK_SIZE)
+            return file.name
+    finally:
+        body.close()
+
+
+def parse_object(key: str, path: str, selected_fields: List[str]) -> pa.Table:
+    """
+    Process an S3 object downloaded to a file, decompressing it on the fly if it is gzipped,
+    and remove the file.
+    """
+    try:
+        with open(path, "rb") as file:
+            stream = gzip.GzipFile(fileobj=file) if key.endswith(".gz") else file
+            return process_object(iter_lines(stream), selected_fields)
+    finally:
+        os.remove(path)
+
+
+def iter_object_keys(s3_client: boto3.client, bucket: str, prefix: str) -> Iterator[str]:
+    """List the keys of all S3 objects under a prefix."""
+    paginator = s3_client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get("Contents", []):
+            yield obj["Key"]
+
+
+def load_objects(
+    s3_client: boto3.client, bucket: str, keys: Iterable[str], selected_fields: List[str]
+) -> List[pa.Table]:
+    """
+    Download and process S3 objects in a pipeline.
+
+    A thread pool downloads up to config.PREFETCH_OBJECTS objects ahead of the ones being
+    processed by config.PARSE_WORKERS processes, so downloads overlap with processing. Objects
+    are downloaded to temporary files which the processes stream, so only chunks of them are
+    held in memory. Both queues are bounded, so at most PREFETCH_OBJECTS + 2 * PARSE_WORKERS
+    objects are on disk at once. With PARSE_WORKERS set to 0, objects are streamed and processed
+    one at a time.
+
+    Returns:
+        list[pa.Table]: The processed objects, in the order of the keys.
+    """
+    if config.PARSE_WORKERS <= 0:
+        return [
+            process_object(iter_object_lines(s3_client, bucket, key), selected_fields)
+            for key in keys
+        ]
+
+    max_parsing = 2 * config.PARSE_WORKERS
+    # With PREFETCH_OBJECTS set to 0, each object is downloaded when it is processed
+    with tempfile.TemporaryDirectory() as directory, ThreadPoolExecutor(
+        max_workers=max(config.PREFETCH_OBJECTS, 1)
+    ) as downloads, ProcessPoolExecutor(max_workers=config.PARSE_WORKERS) as parsers:
+        downloading = deque()
+        parsing = []
+
+        def parse_next():
+            key, download = downloading.popleft()
+            running = [future for future in parsing if not future.done()]
+            if len(running) >= max_parsing:
+                wait(running, return_when=FIRST_COMPLETED)
+            parsing.append(parsers.submit(parse_object, key, download.result(), selected_fields))
+
+        for key in keys:
+            downloading.append(
+                (key, downloads.submit(download_object, s3_client, bucket, key, directory))
+            )
+            if len(downloading) >= config.PREFETCH_OBJECTS:
+                parse_next()
+        while downloading:
+            parse_next()
+
+        return [future.result() for future in parsing]
+
+
+def process_object(lines: Iterable[bytes], selected_fields: List[str]) -> pa.Table:
+    """
+    Process the lines of an S3 object and return a table of its records.
+
+    Lines are converted to a record batch every PROCESS_BATCH_LINES lines, so only the records
+    of a single batch are held as Python objects. Publishers are dictionary-encoded and URLs
+    kept as a flat array with offsets.
+    """
+    return pa.Table.from_batches(iter_record_batches(lines, selected_fields), schema=OBJECT_SCHEMA)
+
+
+def iter_record_batches(lines: Iterable[bytes], selected_fields: List[str]) -> Iterator[pa.RecordBatch]:
+    """Iterate over the records of the lines of an S3 object, PROCESS_BATCH_LINES lines at a time."""
+    columns = {field: [] for field in selected_fields}
+    for number, line in enumerate(lines, 1):
         line = line.strip()
-        if line != "":
+        if line:
             try:
                 doc = json.loads(line)
-                row = {field: doc.get(field) for field in selected_fields}
-                rows.append(row)
+                for field, values in columns.items():
+                    values.append(doc.get(field))
             except json.JSONDecodeError as e:
                 logging.error("Invalid JSON object: %s, errorL %s", line, str(e))
-    df = pd.DataFrame(rows)
-    new_df = df.apply(compute_row_values, axis=1, result_type="expand")
-    return new_df
+        if number % PROCESS_BATCH_LINES == 0 and columns["id"]:
+            yield to_record_batch(columns)
+            columns = {field: [] for field in selected_fields}
+    if columns["id"]:
+        yield to_record_batch(columns)
+
 
+def to_record_batch(columns: Dict[str, list]) -> pa.RecordBatch:
+    """Convert the fields of a batch of records to a record batch of OBJECT_SCHEMA."""
+    urls = pa.array(columns["url"], type=pa.list_(pa.string()))
+    number_urls, number_unique_urls = compute_url_counts(urls)
+
+    return pa.record_batch(
+        {
+            "id": pa.array(columns["id"], type=pa.string()),
+            "publisher": pc.dictionary_encode(pa.array(columns["publisher"], type=pa.string())),
+            "urls": urls,
+            "number_urls": number_urls,
+            "number_unique_urls": number_unique_urls,
+        },
+        schema=OBJECT_SCHEMA,
+    )
+
+
+def compute_url_counts(urls: pa.ListArray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Count the URLs and the case-insensitively unique URLs of each record.
+
+    Args:
+        urls (pa.ListArray): The URLs of each record.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: Number of URLs and number of unique URLs of each record.
+    """
+    number_urls = pc.fill_null(pc.list_value_length(urls), 0).to_numpy().astype(np.int64)
+
+    unique_urls = (
+        pa.table(
+            {
+                "record": pc.list_parent_indices(urls),
+                "url": pc.utf8_lower(pc.list_flatten(urls)),
+            }
+        )
+        .group_by("record")
+        .aggregate([("url", "count_distinct")])
+    )
+    number_unique_urls = np.zeros(len(urls), dtype=np.int64)
+    number_unique_urls[unique_urls["record"].to_numpy()] = unique_urls["url_count_distinct"].to_numpy()
+
+    return number_urls, number_unique_urls
 
-def compute_row_values(row: pd.Series) -> Dict[str, Any]:
-    """Compute additional values for each row."""
-    num_urls = len(row["url"])
-    unique_urls = len(set([url.lower() for url in row["url"]]))
 
-    return {
-        "id": row["id"],
-        "publisher": row["publisher"],
-        "urls": row["url"],
-        "number_urls": num_urls,
-        "number_unique_urls": unique_urls,
-    }
+def group_urls_by_publisher(records: pa.Table) -> pd.DataFrame:
+    """
+    Group the URLs of all records by publisher in a single pass.
+
+    Records are flattened into one row per URL, with the dictionary-encoded publisher of its
+    record, and grouped once. Records without a publisher and missing URLs are skipped.
+
+    Args:
+        records (pa.Table): The records, as returned by process_object.
+
+    Returns:
+        pd.DataFrame: The URLs and the number of URLs of each publisher, in the order
+        the publishers first appear in the records.
+    """
+    records = records.unify_dictionaries()
+    urls = pa.Table.from_batches(
+        [
+            pa.record_batch(
+                {
+                    "publisher": pc.take(batch["publisher"], pc.list_parent_indices(batch["urls"])),
+                    "url": pc.list_flatten(batch["urls"]),
+                }
+            )
+            for batch in records.to_batches()
+        ],
+        schema=pa.schema([("publisher", records.schema.field("publisher").type), ("url", pa.string())]),
+    )
+    urls = urls.filter(pc.and_(pc.is_valid(urls["publisher"]), pc.is_valid(urls["url"])))
+
+    grouped = urls.group_by("publisher", use_threads=False).aggregate([("url", "list"), ("url", "count")])
+
+    return pd.DataFrame(
+        {
+            "publisher": grouped["publisher"].to_pylist(),
+            "urls": grouped["url_list"].to_pylist(),
+            "urls_count": grouped["url_count"].to_numpy(),
+        }
+    )
 
 
 def close_s3_client(s3_client: boto3.client):
@@ -76,47 +301,91 @@ def load_and_process_data() -> pd.DataFrame:
     bucket = config.S3_BUCKET
     selected_fields = ["id", "doi", "publisher", "url"]
     prefix = config.PREFIX
+    # Fail before loading the objects, not once they are processed
+    check_cache_path(config.URLS_BY_PUBLISHER)
 
     s3_client = connect_to_s3(access_key, secret_key, endpoint=endpoint)
 
     try:
-        paginator = s3_client.get_paginator("list_objects_v2")
-        pages = paginator.paginate(Bucket=bucket, Prefix=prefix)
-
-        result_dfs = []
         # Process S3 objects and concatenate the results
-        for page in pages:
-            for obj in page["Contents"]:
-                obj_data = s3_client.get_object(Bucket=bucket, Key=obj["Key"])[
-                    "Body"
-                ].read()
-                result_dfs.append(process_object(obj_data, selected_fields))
-
-        # Concatenate dataframes
-        result_df = pd.concat(result_dfs, ignore_index=True)
-
-        publishers = set(result_df["publisher"].to_list())
-
-        data = []
-        for publisher in publishers:
-            # Filter out NaN values fo each publisher
-            publisher_urls = (
-                result_df["urls"][result_df["publisher"] == publisher]
-                .explode()
-                .dropna()
-                .tolist()
-            )
-
-            if publisher_urls:
-                data.append({"publisher": publisher, "urls": publisher_urls})
+        keys = iter_object_keys(s3_client, bucket, prefix)
+        result_tables = load_objects(s3_client, bucket, keys, selected_fields)
 
-        urls_by_publisher = pd.DataFrame(data)
+        # Group URLs of all records by publisher
+        urls_by_publisher = group_urls_by_publisher(pa.concat_tables(result_tables))
 
-        with open(config.URLS_BY_PUBLISHER, "w", newline="") as file:
-            file.truncate(0)
-            urls_by_publisher.to_csv(file, index=False)
-            logging.info(f"File saved: {file}")
+        save_urls_by_publisher(urls_by_publisher, config.URLS_BY_PUBLISHER)
 
         return urls_by_publisher
     finally:
         close_s3_client(s3_client)
+
+
+def get_source_fingerprint() -> str:
+    """Get a fingerprint of the S3 objects the URLs are loaded from."""
+    source = {"endpoint": config.S3_ENDPOINT, "bucket": config.S3_BUCKET, "prefix": config.PREFIX}
+    return hashlib.sha1(json.dumps(source, sort_keys=True).encode()).hexdigest()
+
+
+def check_cache_path(path: str) -> None:
+    """
+    Check that the cache path is a Parquet file, the cache was a CSV file in earlier versions.
+
+    Raises:
+        ValueError: If the path is not a .parquet file.
+    """
+    if not path.endswith(".parquet"):
+        raise ValueError(
+            f"URLS_BY_PUBLISHER must be a .parquet file, got {path}. The CSV cache of earlier "
+            f"versions is not used anymore, set URLS_BY_PUBLISHER to e.g. "
+            f"'input/urls_by_publisher.parquet' and run with PREPROCESSED = False to rebuild it."
+        )
+
+
+def save_urls_by_publisher(urls_by_publisher: pd.DataFrame, path: str) -> None:
+    """
+    Save the URLs grouped by publisher to a Parquet cache.
+
+    The cache holds its version and the fingerprint of the source objects, so a cache
+    of another version or built from other objects is not loaded.
+    """
+    check_cache_path(path)
+    table = pa.Table.from_pandas(
+        urls_by_publisher,
+        schema=pa.schema(
+            [
+                ("publisher", pa.string()),
+                ("urls", pa.list_(pa.string())),
+                ("urls_count", pa.int64()),
+            ],
+            metadata={"version": CACHE_VERSION, "fingerprint": get_source_fingerprint()},
+        ),
+        preserve_index=False,
+    )
+    pq.write_table(table, path)
+    logging.info(f"File saved: {path}")
+
+
+def load_urls_by_publisher(path: str) -> Optional[pd.DataFrame]:
+    """
+    Load the URLs grouped by publisher from a Parquet cache.
+
+    Returns:
+        pd.DataFrame or None: The URLs grouped by publisher, or None if there is no cache
+        or it is stale.
+    """
+    check_cache_path(path)
+    try:
+        metadata = pq.read_schema(path).metadata or {}
+    except (FileNotFoundError, pa.ArrowInvalid) as e:
+        logging.warning(f"Cache {path} cannot be read: {e}")
+        return None
+
+    if metadata.get(b"version") != CACHE_VERSION.encode():
+        logging.warning(f"Cache {path} is stale: version {metadata.get(b'version')} != {CACHE_VERSION}")
+        return None
+    if metadata.get(b"fingerprint") != get_source_fingerprint().encode():
+        logging.warning(f"Cache {path} is stale: it was built from other S3 objects")
+        return None
+
+    return pq.read_table(path).to_pandas()
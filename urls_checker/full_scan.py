@@ -0,0 +1,308 @@
+import asyncio
+import json
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import httpx
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from aiolimiter import AsyncLimiter
+from contextlib import aclosing
+
+from config import (
+    ERROR_CODES,
+    RETRY_INITIAL_DELAY,
+    RETRY_MAX_DELAY,
+    MAX_CONCURRENT_REQUESTS,
+    HOST_RATE_LIMIT,
+    HOST_RATE_PERIOD,
+    MAX_HOST_CONNECTIONS,
+    INITIAL_BACKOFF,
+    MAX_BACKOFF,
+    HEAD_FIRST,
+    MAX_BODY_BYTES,
+    SCAN_PATH,
+    SCAN_SHARDS,
+    SCAN_WORKERS,
+    SCAN_RATE_LIMIT,
+    SCAN_MAX_RETRIES,
+    SCAN_PART_ROWS,
+)
+from data_loader import get_source_fingerprint
+from request_handlers import HostLimiters, get_response_record, iter_retried_responses
+from utils import RESULTS_SCHEMA
+
+# File describing the URLs and shards of a scan, written once the shards are prepared
+SCAN_MANIFEST = "manifest.json"
+# File marking a shard whose URLs were all scanned
+SHARD_DONE = "_SUCCESS"
+
+
+def get_shard_name(shard):
+    """Get the name of the partition of a shard."""
+    return f"shard={shard:05d}"
+
+
+def explode_urls(urls_by_publisher):
+    """
+    Explode the URLs grouped by publisher into one row per URL.
+
+    Args:
+        urls_by_publisher (pd.DataFrame): The URLs and the number of URLs of each publisher.
+
+    Returns:
+        pa.Table: The publisher and URL of each URL.
+    """
+    urls = pa.array(urls_by_publisher["urls"], type=pa.list_(pa.string()))
+    publishers = pa.array(urls_by_publisher["publisher"], type=pa.string())
+    return pa.table(
+        {
+            "publisher": pc.take(publishers, pc.list_parent_indices(urls)),
+            "url": pc.list_flatten(urls),
+        }
+    )
+
+
+def get_url_hashes(urls):
+    """
+    Get a hash of each URL, giving its shard and its position within the shard.
+
+    The hash is keyed with a fixed key, unlike hash(), so a URL gets the same hash in every
+    process and run, and all rows of a URL get the same hash.
+
+    Args:
+        urls (pa.Array or pa.ChunkedArray): The URLs.
+
+    Returns:
+        np.ndarray: The hash of each URL, as uint64.
+    """
+    return pd.util.hash_array(urls.to_numpy(zero_copy_only=False).astype(object))
+
+
+def prepare_scan(urls_by_publisher, scan_path, shards):
+    """
+    Split the URLs into shards saved as the inputs of the scan, unless a scan of the same
+    URLs and shards was already started in scan_path, which is then resumed.
+
+    Args:
+        urls_by_publisher (pd.DataFrame): The URLs and the number of URLs of each publisher.
+        scan_path (str): The directory of the scan.
+        shards (int): The number of shards.
+
+    Raises:
+        ValueError: If scan_path holds a scan of other URLs or shards.
+    """
+    urls = explode_urls(urls_by_publisher)
+    manifest = {"fingerprint": get_source_fingerprint(), "urls": urls.num_rows, "shards": shards}
+
+    manifest_path = os.path.join(scan_path, SCAN_MANIFEST)
+    if os.path.exists(manifest_path):
+        with open(manifest_path, "r") as file:
+            if json.load(file) != manifest:
+                raise ValueError(
+                    f"{scan_path} holds a scan of other URLs or shards, remove it to start a new scan"
+                )
+        logging.info(f"Resuming the scan in {scan_path}")
+        return
+
+    # Rows sorted by shard and, within a shard, by hash, which mixes the URLs of all publishers
+    # and hosts instead of keeping them publisher after publisher
+    hashes = get_url_hashes(urls["url"])
+    url_shards = (hashes % np.uint64(shards)).astype(np.int64)
+    order = np.lexsort((hashes, url_shards))
+    urls = urls.take(order)
+    bounds = np.searchsorted(url_shards[order], np.arange(shards + 1))
+
+    input_path = os.path.join(scan_path, "input")
+    os.makedirs(input_path, exist_ok=True)
+    for shard in range(shards):
+        pq.write_table(
+            urls.slice(bounds[shard], bounds[shard + 1] - bounds[shard]),
+            os.path.join(input_path, f"{get_shard_name(shard)}.parquet"),
+        )
+
+    with open(f"{manifest_path}.tmp", "w") as file:
+        json.dump(manifest, file)
+    os.replace(f"{manifest_path}.tmp", manifest_path)
+    logging.info(f"{urls.num_rows} URLs split into {shards} shards in {scan_path}")
+
+
+def load_scanned_urls(shard_path):
+    """
+    Load the URLs already saved in the parts of a shard.
+
+    Args:
+        shard_path (str): The results directory of the shard.
+
+    Returns:
+        tuple[set, int]: The scanned URLs and the number of the next part.
+    """
+    scanned_urls = set()
+    parts = 0
+    for name in sorted(os.listdir(shard_path)):
+        if name.endswith(".tmp"):
+            # Left by a run killed while saving the part
+            os.remove(os.path.join(shard_path, name))
+        elif name.startswith("part-"):
+            scanned_urls.update(pq.read_table(os.path.join(shard_path, name), columns=["url"])["url"].to_pylist())
+            parts += 1
+    return scanned_urls, parts
+
+
+def save_part(records, shard_path, part):
+    """
+    Save the response records of a shard as its next part, written to a temporary file
+    first so that a part is either complete or missing.
+
+    Args:
+        records (list[dict]): The response records, with the columns of RESULTS_SCHEMA.
+        shard_path (str): The results directory of the shard.
+        part (int): The number of the part.
+    """
+    path = os.path.join(shard_path, f"part-{part:05d}.parquet")
+    tmp_path = os.path.join(shard_path, f".part-{part:05d}.parquet.tmp")
+    pq.write_table(pa.Table.from_pylist(records, schema=RESULTS_SCHEMA), tmp_path)
+    os.replace(tmp_path, path)
+    logging.info(f"File saved: {path}")
+
+
+async def scan_shard_async(scan_path, shard, workers):
+    """
+    Request the URLs of a shard which are not saved yet, with its own client and limiters,
+    and save their response records in parts of SCAN_PART_ROWS rows.
+
+    Each of the workers gets its share of the global and per-host rate limits, of the
+    concurrent requests and of the connections to a host. The URLs of the shard come in the
+    order of their hash, so they mix all hosts, and iter_retried_responses requests each host
+    as its limits allow without holding requests to other hosts back.
+
+    Args:
+        scan_path (str): The directory of the scan.
+        shard (int): The shard to scan.
+        workers (int): The number of processes scanning shards at once.
+
+    Returns:
+        int: The number of URLs requested.
+    """
+    shard_name = get_shard_name(shard)
+    urls = pq.read_table(os.path.join(scan_path, "input", f"{shard_name}.parquet")).to_pandas()
+    shard_path = os.path.join(scan_path, "results", shard_name)
+    os.makedirs(shard_path, exist_ok=True)
+
+    # Every row of a URL gets the response of a single request
+    publishers = urls.groupby("url", sort=False)["publisher"].agg(list)
+    scanned_urls, part = load_scanned_urls(shard_path)
+    pending_urls = [url for url in publishers.index if url not in scanned_urls]
+    logging.info(f"Shard {shard}: {len(pending_urls)} of {len(publishers)} URLs left to scan")
+
+    max_concurrency = max(MAX_CONCURRENT_REQUESTS // workers, 1)
+    rate_limit = AsyncLimiter(SCAN_RATE_LIMIT, workers)
+    # A single request per interval, so the workers together do not send bursts to a host
+    host_limiters = HostLimiters(
+        1,
+        HOST_RATE_PERIOD * workers / HOST_RATE_LIMIT,
+        max(MAX_HOST_CONNECTIONS // workers, 1),
+        INITIAL_BACKOFF,
+        MAX_BACKOFF,
+    )
+
+    records = []
+    async with httpx.AsyncClient(
+        limits=httpx.Limits(max_connections=max_concurrency), verify=False
+    ) as client:
+        responses = iter_retried_responses(
+            client,
+            pending_urls,
+            rate_limit,
+            lambda response: response.status_code in ERROR_CODES,
+            SCAN_MAX_RETRIES,
+            RETRY_INITIAL_DELAY,
+            RETRY_MAX_DELAY,
+            max_concurrency,
+            host_limiters=host_limiters,
+            head_first=HEAD_FIRST,
+            max_body_bytes=MAX_BODY_BYTES,
+        )
+        async with aclosing(responses):
+            async for url, response, final in responses:
+                # Only the final response to a URL is saved
+                if not final:
+                    continue
+
+                record = get_response_record(response)
+                records.extend(
+                    {"publisher": publisher, "url": url, **record} for publisher in publishers[url]
+                )
+                if len(records) >= SCAN_PART_ROWS:
+                    save_part(records, shard_path, part)
+                    records = []
+                    part += 1
+
+    if records:
+        save_part(records, shard_path, part)
+    open(os.path.join(shard_path, SHARD_DONE), "w").close()
+    return len(pending_urls)
+
+
+def scan_shard(scan_path, shard, workers):
+    """Scan a shard in its own event loop, run in a worker process."""
+    return asyncio.run(scan_shard_async(scan_path, shard, workers))
+
+
+def run_full_scan(urls_by_publisher):
+    """
+    Request every URL, not a sample, and save the response records as a Parquet dataset
+    partitioned by shard in SCAN_PATH/results.
+
+    The URLs are split into SCAN_SHARDS shards by a hash of the URL, scanned by SCAN_WORKERS
+    processes. Responses are saved in parts as they come, so a killed scan is resumed by
+    running it again: finished shards are skipped and URLs already saved are not requested.
+
+    Args:
+        urls_by_publisher (pd.DataFrame): The URLs and the number of URLs of each publisher.
+
+    Returns:
+        str: The directory of the results.
+    """
+    prepare_scan(urls_by_publisher, SCAN_PATH, SCAN_SHARDS)
+
+    results_path = os.path.join(SCAN_PATH, "results")
+    pending_shards = [
+        shard
+        for shard in range(SCAN_SHARDS)
+        if not os.path.exists(os.path.join(results_path, get_shard_name(shard), SHARD_DONE))
+    ]
+    logging.info(f"{len(pending_shards)} of {SCAN_SHARDS} shards left to scan")
+
+    if SCAN_WORKERS > 1:
+        with ProcessPoolExecutor(max_workers=SCAN_WORKERS) as executor:
+            futures = {
+                executor.submit(scan_shard, SCAN_PATH, shard, SCAN_WORKERS): shard
+                for shard in pending_shards
+            }
+            for future in as_completed(futures):
+                logging.info(f"Shard {futures[future]} scanned: {future.result()} URLs requested")
+    else:
+        for shard in pending_shards:
+            logging.info(f"Shard {shard} scanned: {scan_shard(SCAN_PATH, shard, 1)} URLs requested")
+
+    return results_path
+
+
+def load_scan_code_counts(results_path):
+    """
+    Count the response records of a full scan with each response code.
+
+    Args:
+        results_path (str): The directory of the results, as returned by run_full_scan.
+
+    Returns:
+        pd.Series: The number of records with each response code.
+    """
+    response_codes = pq.read_table(results_path, columns=["response_code"])["response_code"]
+    return response_codes.to_pandas().value_counts()
@@ -1,159 +1,160 @@
 import asyncio
 import logging
-import ast
 import os
 
 import httpx
-import numpy as np
 import pandas as pd
 
 from aiolimiter import AsyncLimiter
-import concurrent.futures
+from contextlib import aclosing
 
 from config import OUTPUT_PATH, URLS_BY_PUBLISHER, SAMPLE, PREPROCESSED
 from config import (
     SEEDS,
     ERROR_CODES,
-    INITIAL_SLEEP_DURATION,
     ERRORS_TO_KEEP_PERCENTAGE,
-    THREADS,
-    MAX_WORKERS,
+    RETRY_INITIAL_DELAY,
+    RETRY_MAX_DELAY,
+    MAX_RETRIES,
+    MAX_CONCURRENT_REQUESTS,
+    RATE_LIMIT,
+    HOST_RATE_LIMIT,
+    HOST_RATE_PERIOD,
+    MAX_HOST_CONNECTIONS,
+    INITIAL_BACKOFF,
+    MAX_BACKOFF,
+    HEAD_FIRST,
+    MAX_BODY_BYTES,
+    TOP_PUBLISHERS,
+    RESPONSE_CACHE,
+    RESPONSE_CACHE_TTL,
+    RESPONSE_CACHE_MAX_ENTRIES,
+    FULL_SCAN,
+    SCAN_PATH,
 )
-from data_loader import load_and_process_data
-from request_handlers import async_request_publisher_data, sync_request_data
-from utils import extract_response_code
-
-# Clear the log file
-log_file = "logfile.log"
-if os.path.exists(log_file):
-    open(log_file, "w").close()
-
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-    handlers=[logging.StreamHandler(), logging.FileHandler("logfile.log")],
+from data_loader import load_and_process_data, load_urls_by_publisher
+from full_scan import load_scan_code_counts, run_full_scan
+from request_handlers import (
+    HostLimiters,
+    get_response_record,
+    iter_async_responses,
+    iter_retried_responses,
+)
+from response_cache import ResponseCache
+from utils import (
+    append_results,
+    compact_results,
+    draw_stratified_sample,
+    get_sample_strata,
+    load_results,
+    merge_retry_responses,
+    save_results,
 )
 
-
-def convert_to_list(s):
-    """Convert a string representation of a list to an actual list."""
-    try:
-        return ast.literal_eval(s)
-    except ValueError:
-        return []
-
-
-def fetch_data(url):
-    with httpx.Client(verify=False) as client:
-        response = sync_request_data(client, url)
-        return {"url": url, "response": str(response)}
+# Number of retried responses merged into the sample and logged at once
+RETRY_SAVE_BATCH = 100
 
 
-# Load and preprocess data
-preprocessed = PREPROCESSED
-if preprocessed:
-    # Load preprocessed data
-    with open(URLS_BY_PUBLISHER, "r", newline="") as file:
-        urls_by_publisher = pd.read_csv(file)
+def setup_logging():
+    """Clear the log file and configure logging."""
+    # Clear the log file
+    log_file = "logfile.log"
+    if os.path.exists(log_file):
+        open(log_file, "w").close()
 
-    list_columns = ["urls"]
-    urls_by_publisher[list_columns] = urls_by_publisher[list_columns].map(
-        convert_to_list
+    # Configure logging
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+        handlers=[logging.StreamHandler(), logging.FileHandler("logfile.log")],
     )
-else:
-    # Load and preprocess data
-    urls_by_publisher = load_and_process_data()
 
-# Calculate URL statistics
-urls_by_publisher.loc[:, "urls_count"] = urls_by_publisher["urls"].apply(
-    lambda x: len(x)
-)
-total_urls = urls_by_publisher["urls_count"].sum()
-urls_by_publisher.loc[:, "urls_percentage"] = (
-    urls_by_publisher["urls_count"] / total_urls * 100
-)
 
-# Calculate top 8 publishers by URLs
-top_8_publishers_by_urls = (
-    urls_by_publisher[["publisher", "urls_percentage"]]
-    .sort_values(by="urls_percentage", ascending=False)
-    .head(8)
-)
-
-urls_total_sample = int(round(total_urls * SAMPLE, 0))
-top_8_publishers_by_urls.loc[:, "sample_count"] = round(
-    top_8_publishers_by_urls["urls_percentage"] * urls_total_sample / 100, 0
-)
-
-rest_sample = round(
-    urls_total_sample - top_8_publishers_by_urls["sample_count"].sum(), 0
-)
+def load_data():
+    """Load the URLs grouped by publisher from the cache, or from S3 if it is missing or stale."""
+    urls_by_publisher = None
+    if PREPROCESSED:
+        # Load preprocessed data, unless the cache is missing or stale
+        urls_by_publisher = load_urls_by_publisher(URLS_BY_PUBLISHER)
+    if urls_by_publisher is None:
+        # Load and preprocess data
+        urls_by_publisher = load_and_process_data()
+    return urls_by_publisher
 
 
 # Main data collection process
-async def main(seed):
-    np.random.seed(seed)
-
-    top_8_publishers = top_8_publishers_by_urls["publisher"].tolist()
-    rest_publishers = urls_by_publisher[
-        ~urls_by_publisher["publisher"].isin(top_8_publishers)
-    ]["publisher"].tolist()
-
-    # Explode URLs
-    exploded_urls = urls_by_publisher[["publisher", "urls"]].explode("urls")
-    sample_urls = []
-
-    for publisher in top_8_publishers:
-        urls = exploded_urls[exploded_urls["publisher"] == publisher]["urls"].tolist()
-        sample_count = int(
-            top_8_publishers_by_urls[
-                top_8_publishers_by_urls["publisher"] == publisher
-            ]["sample_count"].iloc[0]
-        )
-        selected_urls = np.random.choice(urls, size=sample_count, replace=False)
-        sample_urls.extend([(publisher, url) for url in selected_urls])
-
-    # Sample URLs for the rest publishers
-    rest_sample_urls = exploded_urls[
-        exploded_urls["publisher"].isin(rest_publishers)
-    ].sample(n=int(rest_sample), random_state=seed)
-    sample_urls.extend(
-        [(row["publisher"], row["urls"]) for _, row in rest_sample_urls.iterrows()]
+async def main(seed, urls_by_publisher, client, rate_limit, host_limiters, response_cache=None):
+    publisher_strata, strata_sample_counts = get_sample_strata(
+        urls_by_publisher, TOP_PUBLISHERS, SAMPLE
     )
+    sample_urls = draw_stratified_sample(
+        urls_by_publisher, publisher_strata, strata_sample_counts, seed
+    )
+    urls = [url for _, url in sample_urls]
 
     # additional saving used to find what is wrong with URLs
     # sample_urls_df = pd.DataFrame(sample_urls)
     # sample_urls_df.to_csv('output/sample_urls_df.csv', index=False)
 
-    rate_limit = AsyncLimiter(150, 5)
-    async with httpx.AsyncClient(
-        limits=httpx.Limits(max_connections=750), verify=False
-    ) as client:
-        sample_results = []
-        for publisher, url in sample_urls:
-            response = await async_request_publisher_data(client, [url], rate_limit)
-            sample_results.append(
-                {"publisher": publisher, "url": url, "response": str(response)}
-            )
+    # Results are kept in the order of the sample, whichever request completes first
+    sample_results = [None] * len(sample_urls)
+    # Responses with an error code, whose retries wait for the delay they ask for
+    error_responses = {}
+
+    # Responses cached by previous seeds or runs are not requested again
+    cached_records = response_cache.get_many(urls) if response_cache else {}
+    for index, (publisher, url) in enumerate(sample_urls):
+        if url in cached_records:
+            sample_results[index] = {"publisher": publisher, "url": url, **cached_records[url]}
+    requested_indices = [index for index, url in enumerate(urls) if url not in cached_records]
+    logging.info(
+        f"{len(urls) - len(requested_indices)} of {len(urls)} responses taken from the cache"
+    )
 
-    return sample_results
+    responses = iter_async_responses(
+        client,
+        [urls[index] for index in requested_indices],
+        rate_limit,
+        MAX_CONCURRENT_REQUESTS,
+        host_limiters=host_limiters,
+        head_first=HEAD_FIRST,
+        max_body_bytes=MAX_BODY_BYTES,
+    )
+    async for position, response in responses:
+        index = requested_indices[position]
+        publisher, url = sample_urls[index]
+        sample_results[index] = {
+            "publisher": publisher,
+            "url": url,
+            **get_response_record(response),
+        }
+        if response.status_code in ERROR_CODES:
+            error_responses[url] = response
+
+    if response_cache:
+        cache_responses(
+            response_cache,
+            [{"url": urls[index], **sample_results[index]} for index in requested_indices],
+        )
 
+    return sample_results, error_responses
 
-# Processing and saving results
-async def analyze_and_save(sample_results, filename):
-    sample_df = pd.DataFrame(sample_results)
 
-    with open(f"{filename}.csv", "w", newline="") as file:
-        file.truncate(0)
+def cache_responses(response_cache, records):
+    """Store the records of the responses which are not errors, errors are requested again."""
+    response_cache.put_many(
+        [
+            {key: value for key, value in record.items() if key != "publisher"}
+            for record in records
+            if record["response_code"] not in ERROR_CODES
+        ]
+    )
 
-        sample_df.to_csv(file, index=False)
-        logging.info(f"File saved: {file}")
 
-    sample_df["response_code"] = sample_df["response"].apply(extract_response_code)
-    sample_code_count = (
-        sample_df.groupby("response_code").size().reset_index(name="count")
-    )
+def save_code_counts(code_counts, filename):
+    """Save the number and percentage of responses with each response code."""
+    code_counts = code_counts[code_counts > 0].sort_index()
+    sample_code_count = code_counts.rename_axis("response_code").reset_index(name="count")
     sample_count = sample_code_count["count"].sum()
     sample_code_count.loc[:, "count_percent"] = (
         sample_code_count["count"] / sample_count * 100
@@ -161,95 +162,169 @@ async def analyze_and_save(sample_results, filename):
 
     with open(f"{filename}_count.csv", "w", newline="") as file:
         file.truncate(0)
-
         sample_code_count.to_csv(file, index=False)
         logging.info(f"File saved: {file}")
 
-    retry_needed = True
-    error_codes = ERROR_CODES
-    errors_to_keep = round(len(sample_df) * ERRORS_TO_KEEP_PERCENTAGE, 0)
 
-    initial_sleep_duration = INITIAL_SLEEP_DURATION
+def save_retry_responses(sample_df, retry_responses, code_counts, filename, response_cache=None):
+    """
+    Merge retried responses into the sample, log them and save the updated response code counts.
 
-    while retry_needed:
-        # Identify URLSs with status code 4290
-        urls_with_errors = sample_df[sample_df["response_code"].isin(error_codes)][
-            "url"
-        ]
+    Args:
+        sample_df (pd.DataFrame): The responses of the sample, updated in place.
+        retry_responses (list[dict]): The responses of the retried URLs.
+        code_counts (pd.Series): The number of responses with each response code.
+        filename (str): The path of the saved results, without extension.
+        response_cache (ResponseCache): The cache the retried responses are stored in, if any.
 
-        retry_responses = []
-        if len(urls_with_errors) > errors_to_keep:
-            if THREADS:
-                with concurrent.futures.ThreadPoolExecutor(
-                    max_workers=MAX_WORKERS
-                ) as executor:
-                    # Submit tasks for each URL
-                    futures = [
-                        executor.submit(fetch_data, url) for url in urls_with_errors
-                    ]
-
-                    # Retrieve results as they complete
-                    for future in concurrent.futures.as_completed(futures):
-                        response_data = future.result()
-                        retry_responses.append(response_data)
-            else:
-                with httpx.Client(verify=False) as client:
-                    for url in urls_with_errors:
-                        response = sync_request_data(client, url)
-                        retry_responses.append({"url": url, "response": str(response)})
-
-            retry_responses = pd.DataFrame(retry_responses)
-
-            # Update responses for URLs with status code 429
-            for _, row in retry_responses.iterrows():
-                sample_df.loc[sample_df["url"] == row["url"], "response"] = str(
-                    row["response"]
-                )
-
-            # Save the updated DataFrame
-            sample_df["response_code"] = sample_df["response"].apply(
-                extract_response_code
-            )
+    Returns:
+        pd.Series: The updated number of responses with each response code.
+    """
+    retry_df = pd.DataFrame(retry_responses)
+    if response_cache:
+        cache_responses(response_cache, retry_responses)
 
-            with open(f"{filename}.csv", "w", newline="") as file:
-                file.truncate(0)
-                sample_df.to_csv(file, index=False)
-                logging.info(f"File saved: {file}")
+    # Update responses for URLs with status code 429, counting only the changed codes again
+    previous_codes = sample_df.loc[sample_df["url"].isin(retry_df["url"]), "response_code"]
+    updated_rows = merge_retry_responses(sample_df, retry_df)
+    code_counts = code_counts.sub(
+        previous_codes.value_counts(), fill_value=0
+    ).add(sample_df.loc[updated_rows, "response_code"].value_counts(), fill_value=0)
+    code_counts = code_counts.astype(int)
 
-            sample_code_count = (
-                sample_df.groupby("response_code").size().reset_index(name="count")
-            )
-            sample_count = sample_code_count["count"].sum()
-            sample_code_count.loc[:, "count_percent"] = (
-                sample_code_count["count"] / sample_count * 100
-            )
+    # Log the retried responses, the sample is compacted with them once retries are done
+    append_results(retry_df, f"{filename}_retries.jsonl")
+    save_code_counts(code_counts, filename)
+    return code_counts
 
-            with open(f"{filename}_count.csv", "w", newline="") as file:
-                file.truncate(0)
-                sample_code_count.to_csv(file, index=False)
-                logging.info(f"File saved: {file}")
-        else:
-            retry_needed = False
 
-        initial_sleep_duration -= 5
-        if initial_sleep_duration <= 0:
-            initial_sleep_duration = 5
+# Processing and saving results
+async def analyze_and_save(
+    sample_results,
+    error_responses,
+    filename,
+    client,
+    rate_limit,
+    host_limiters,
+    response_cache=None,
+):
+    sample_df = pd.DataFrame(sample_results)
 
-        # Sleep for 5 minutes before the next iteration
-        print(
-            f"Sleeping for {initial_sleep_duration} seconds before the next iteration..."
-        )
-        await asyncio.sleep(initial_sleep_duration)
+    save_results(sample_df, f"{filename}.parquet")
 
-        with open(f"{filename}.csv", "r") as file:
-            sample_df = pd.read_csv(file)
+    code_counts = sample_df["response_code"].value_counts()
+    save_code_counts(code_counts, filename)
 
+    error_codes = ERROR_CODES
+    errors_to_keep = round(len(sample_df) * ERRORS_TO_KEEP_PERCENTAGE, 0)
+
+    # Number of rows of each URL with an error code, retried until few enough are left
+    error_rows = sample_df.loc[sample_df["response_code"].isin(error_codes), "url"].value_counts()
+    url_rows = sample_df.loc[sample_df["url"].isin(error_rows.index), "url"].value_counts().to_dict()
+    error_rows = error_rows.to_dict()
+    errors_left = sum(error_rows.values())
+
+    retry_responses = []
+    if errors_left > errors_to_keep:
+        responses = iter_retried_responses(
+            client,
+            list(error_rows),
+            rate_limit,
+            lambda response: response.status_code in error_codes,
+            MAX_RETRIES,
+            RETRY_INITIAL_DELAY,
+            RETRY_MAX_DELAY,
+            MAX_CONCURRENT_REQUESTS,
+            host_limiters=host_limiters,
+            # Every URL was requested once already, by main() or by the killed run
+            previous_responses={url: error_responses.get(url) for url in error_rows},
+            head_first=HEAD_FIRST,
+            max_body_bytes=MAX_BODY_BYTES,
+        )
+        async with aclosing(responses):
+            async for url, response, _ in responses:
+                retry_responses.append({"url": url, **get_response_record(response)})
+
+                # All rows of the URL get the response of the retry
+                url_errors = url_rows[url] if response.status_code in error_codes else 0
+                errors_left += url_errors - error_rows[url]
+                error_rows[url] = url_errors
+
+                if len(retry_responses) >= RETRY_SAVE_BATCH:
+                    code_counts = save_retry_responses(
+                        sample_df, retry_responses, code_counts, filename, response_cache
+                    )
+                    retry_responses = []
+                if errors_left <= errors_to_keep:
+                    break
+
+    if retry_responses:
+        code_counts = save_retry_responses(
+            sample_df, retry_responses, code_counts, filename, response_cache
+        )
+
+    compact_results(f"{filename}.parquet", f"{filename}_retries.jsonl")
 
-if __name__ == "__main__":
-    for seed in SEEDS:
-        loop = asyncio.get_event_loop()
-        sample_results = loop.run_until_complete(main(seed))
 
+async def run(seed, urls_by_publisher, response_cache=None):
+    """Collect and save the responses of the sample of a seed, sharing one client between requests and retries."""
+    rate_limit = AsyncLimiter(RATE_LIMIT, 1)
+    host_limiters = HostLimiters(
+        HOST_RATE_LIMIT, HOST_RATE_PERIOD, MAX_HOST_CONNECTIONS, INITIAL_BACKOFF, MAX_BACKOFF
+    )
+    async with httpx.AsyncClient(
+        limits=httpx.Limits(max_connections=750), verify=False
+    ) as client:
         # Save results with seed number in the filename
         filename = f"{OUTPUT_PATH}/urls_sample_seed_{seed}"
-        loop.run_until_complete(analyze_and_save(sample_results, filename))
+
+        if os.path.exists(f"{filename}_retries.jsonl"):
+            # A previous run of the seed was killed while retrying, its retries are applied and resumed
+            compact_results(f"{filename}.parquet", f"{filename}_retries.jsonl")
+            sample_results = load_results(f"{filename}.parquet")
+            # Only the response records are saved, not the responses themselves
+            error_responses = {}
+            logging.info(f"Resuming the retries of {filename}.parquet")
+        else:
+            sample_results, error_responses = await main(
+                seed, urls_by_publisher, client, rate_limit, host_limiters, response_cache
+            )
+
+        await analyze_and_save(
+            sample_results,
+            error_responses,
+            filename,
+            client,
+            rate_limit,
+            host_limiters,
+            response_cache,
+        )
+
+
+def run_full_scan_and_save(urls_by_publisher):
+    """Request every URL and save the response code counts of the full scan."""
+    results_path = run_full_scan(urls_by_publisher)
+    save_code_counts(load_scan_code_counts(results_path), f"{SCAN_PATH}/full_scan")
+
+
+if __name__ == "__main__":
+    # Worker processes import this module too, so nothing runs outside of this guard
+    setup_logging()
+    urls_by_publisher = load_data()
+
+    if FULL_SCAN:
+        run_full_scan_and_save(urls_by_publisher)
+    else:
+        # The cache is shared by all seeds, so URLs sampled by several seeds are requested once
+        response_cache = (
+            ResponseCache(RESPONSE_CACHE, RESPONSE_CACHE_TTL, RESPONSE_CACHE_MAX_ENTRIES)
+            if RESPONSE_CACHE
+            else None
+        )
+        try:
+            for seed in SEEDS:
+                asyncio.run(run(seed, urls_by_publisher, response_cache))
+        finally:
+            if response_cache:
+                response_cache.evict()
+                response_cache.close()
@@ -1,5 +1,13 @@
 import asyncio
+import heapq
+import itertools
 import logging
+import random
+import time
+from collections import defaultdict, deque
+from contextlib import nullcontext
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
 
 import httpx
 from aiolimiter import AsyncLimiter
@@ -9,6 +17,10 @@ ERROR_CODE_CONNECTION = 1
 ERROR_CODE_TIMEOUT = 2
 ERROR_CODE_REQUEST_ERROR = 3
 
+TOO_MANY_REQUESTS = 429
+
+REQUEST_TIMEOUT = 30.0
+
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,
@@ -32,69 +44,456 @@ def handle_exception(url, e):
         f"Error occurred for URL: {url}, Error: {type(e).__name__}, message {e}"
     )
     logging.error(error_message)
+    extensions = {"error": type(e).__name__}
     if isinstance(e, httpx.RequestError):
-        return httpx.Response(status_code=ERROR_CODE_REQUEST_ERROR)
+        return httpx.Response(status_code=ERROR_CODE_REQUEST_ERROR, extensions=extensions)
     elif isinstance(e, httpx.TimeoutException):
-        return httpx.Response(status_code=ERROR_CODE_TIMEOUT)
+        return httpx.Response(status_code=ERROR_CODE_TIMEOUT, extensions=extensions)
     elif isinstance(e, httpx.ConnectError):
-        return httpx.Response(status_code=ERROR_CODE_CONNECTION)
+        return httpx.Response(status_code=ERROR_CODE_CONNECTION, extensions=extensions)
     else:
-        return httpx.Response(status_code=ERROR_CODE_REQUEST_ERROR)
+        return httpx.Response(status_code=ERROR_CODE_REQUEST_ERROR, extensions=extensions)
 
 
-async def async_request_data(client, url, limiter, retry_count=3):
+def get_response_record(response):
+    """
+    Get the fields of a response recorded by the checker.
+
+    Args:
+        response (httpx.Response): The response, as returned by async_request_data.
+
+    Returns:
+        dict: Status code, class of the exception for failed requests, final URL after redirects,
+        number of redirects, time taken by the request in seconds and announced body length.
+    """
+    error = response.extensions.get("error")
+    content_length = response.headers.get("Content-Length", "")
+    return {
+        "response_code": response.status_code,
+        "error": error,
+        "final_url": None if error else str(response.url),
+        "redirects": len(response.history),
+        "elapsed": response.extensions.get("elapsed"),
+        "content_length": int(content_length) if content_length.isdigit() else None,
+    }
+
+
+def get_retry_after(response):
+    """
+    Get the delay requested by the Retry-After header of a response.
+
+    Args:
+        response (httpx.Response): The response.
+
+    Returns:
+        float or None: The delay in seconds, or None if the header is missing or invalid.
+    """
+    retry_after = response.headers.get("Retry-After")
+    if retry_after is None:
+        return None
+    try:
+        return max(float(retry_after), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(retry_after).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+class HostLimiter:
+    """
+    Rate limit, connection cap and backoff of requests to a single host.
+
+    After a 429 response the host is paused for the delay of its Retry-After header,
+    or an exponentially growing delay if there is none, until a request succeeds.
+    """
+
+    def __init__(self, max_rate, time_period, max_connections, initial_backoff, max_backoff):
+        self.limiter = AsyncLimiter(max_rate, time_period)
+        self.connections = asyncio.Semaphore(max_connections)
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.backoff_count = 0
+        self.paused_until = 0.0
+
+    async def __aenter__(self):
+        await self.connections.acquire()
+        try:
+            while (delay := self.paused_until - time.monotonic()) > 0:
+                await asyncio.sleep(delay)
+            await self.limiter.acquire()
+        except BaseException:
+            self.connections.release()
+            raise
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.connections.release()
+
+    def backoff(self, retry_after=None):
+        """
+        Pause requests to the host after a 429 response.
+
+        Args:
+            retry_after (float or None): The delay requested by the host, if any.
+
+        Returns:
+            float: The delay of the pause in seconds.
+        """
+        if retry_after is None:
+            retry_after = min(self.initial_backoff * 2**self.backoff_count, self.max_backoff)
+        self.backoff_count += 1
+        self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+        return retry_after
+
+    def reset(self):
+        """Reset the backoff of the host after a successful request."""
+        self.backoff_count = 0
+
+
+class HostLimiters:
+    """
+    Registry of the HostLimiter of each host, created on the first request to the host.
+
+    Args:
+        max_rate (float): The maximum number of requests to a host per time_period.
+        time_period (float): The period of the rate limit in seconds.
+        max_connections (int): The maximum number of concurrent requests to a host.
+        initial_backoff (float): The pause after the first 429 response without Retry-After.
+        max_backoff (float): The longest pause waited for before retrying a request.
+    """
+
+    def __init__(self, max_rate, time_period, max_connections, initial_backoff, max_backoff):
+        self.max_rate = max_rate
+        self.time_period = time_period
+        self.max_connections = max_connections
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.hosts = {}
+
+    def get(self, url):
+        """Get the HostLimiter of the host of a URL."""
+        host = (urlsplit(url).hostname or "").lower()
+        if host not in self.hosts:
+            self.hosts[host] = HostLimiter(
+                self.max_rate,
+                self.time_period,
+                self.max_connections,
+                self.initial_backoff,
+                self.max_backoff,
+            )
+        return self.hosts[host]
+
+
+def is_head_rejected(response):
+    """
+    Check whether a response to a HEAD request may differ from the response to a GET request.
+    Many servers answer HEAD requests with an error, e.g. 405 Method Not Allowed.
+    """
+    return response.status_code >= 400 and response.status_code != TOO_MANY_REQUESTS
+
+
+async def async_request_data(
+    client,
+    url,
+    limiter,
+    retry_count=3,
+    host_limiters=None,
+    head_first=False,
+    max_body_bytes=None,
+    slots=None,
+):
     """
     Asynchronously request data from a URL using an HTTP client.
 
+    With host_limiters, requests are also limited per host, and a request answered with 429
+    pauses its host and is retried, up to retry_count times, once the host backoff has passed.
+    Responses asking to wait longer than the maximum backoff of host_limiters are returned as
+    they are.
+    One of the slots is taken only once the host has capacity, so requests waiting for a
+    slow or paused host do not hold slots requests to other hosts could use.
+
     Args:
         client (httpx.AsyncClient): The HTTP client to use.
         url (str): The URL to request data from.
         limiter (aiolimiter.AsyncLimiter): An async limiter for rate limiting.
         retry_count (int): The maximum number of retries failed for failed request.
+        host_limiters (HostLimiters): Per-host rate limiters, connection caps and backoff.
+        head_first (bool): Whether to request the URL with HEAD, falling back to GET
+            only if the HEAD request is rejected.
+        max_body_bytes (int): The maximum number of bytes of the body downloaded by GET,
+            0 to close the response after its headers, None to download the whole body.
+        slots (asyncio.Semaphore): The slots shared by all concurrent requests, if any.
 
     Return:
         httpx.Response: The HTTP response.
     """
-    async with limiter:
-        try:
+    slots = slots or nullcontext()
+    if host_limiters is None:
+        async with slots, limiter:
+            return await _async_probe(client, url, head_first, max_body_bytes)
+
+    host_limiter = host_limiters.get(url)
+    for attempt in range(retry_count + 1):
+        async with host_limiter:
+            async with slots, limiter:
+                response = await _async_probe(client, url, head_first, max_body_bytes)
+
+        if response.status_code != TOO_MANY_REQUESTS:
+            host_limiter.reset()
+            return response
+
+        retry_after = get_retry_after(response)
+        if (retry_after or 0) > host_limiters.max_backoff:
+            return response
+        # The host is paused for its other URLs even if this request is not retried here
+        delay = host_limiter.backoff(retry_after)
+        if attempt == retry_count:
+            return response
+        logging.info(f"Too many requests for URL: {url}, retrying in {delay:.1f} seconds")
+    return response
+
+
+async def _async_probe(client, url, head_first, max_body_bytes):
+    started = time.monotonic()
+    response = await _async_request(client, url, head_first, max_body_bytes)
+    response.extensions["elapsed"] = time.monotonic() - started
+    return response
+
+
+async def _async_request(client, url, head_first, max_body_bytes):
+    try:
+        if head_first:
+            response = await client.head(
+                url, follow_redirects=True, timeout=httpx.Timeout(REQUEST_TIMEOUT)
+            )
+            if not is_head_rejected(response):
+                return response
+
+        if max_body_bytes is None:
             response = await client.get(
-                url, follow_redirects=True, timeout=httpx.Timeout(30.0)
+                url, follow_redirects=True, timeout=httpx.Timeout(REQUEST_TIMEOUT)
             )
             return response
-        except (httpx.RequestError, httpx.TimeoutException, httpx.ConnectError) as e:
-            return handle_exception(url, e)
 
+        async with client.stream(
+            "GET", url, follow_redirects=True, timeout=httpx.Timeout(REQUEST_TIMEOUT)
+        ) as response:
+            if max_body_bytes > 0:
+                async for _ in response.aiter_raw():
+                    if response.num_bytes_downloaded >= max_body_bytes:
+                        break
+        return response
+    except (httpx.RequestError, httpx.TimeoutException, httpx.ConnectError) as e:
+        return handle_exception(url, e)
 
-async def async_request_publisher_data(client, urls, limiter):
+
+async def iter_async_responses(
+    client, urls, limiter, max_concurrency, host_limiters=None, **request_kwargs
+):
     """
-    Asynchronously request data from multiple URLs using an HTTP client.
+    Asynchronously request data from multiple URLs, with at most max_concurrency requests in flight.
+
+    Responses are yielded as soon as they arrive, together with the index of their URL, so the
+    caller can keep them in the order of the URLs. With host_limiters, the URLs of each host
+    are requested by workers of their own, as many as the connection cap of a host, which take
+    one of the max_concurrency slots only once the host has capacity.
 
     Args:
         client (httpx.AsyncClient): The HTTP client to use.
         urls (list): List of URLs to request data from.
         limiter (aiolimiter.AsyncLimiter): An async limiter for rate limiting.
+        max_concurrency (int): The maximum number of concurrent requests.
+        host_limiters (HostLimiters): Per-host rate limiters, connection caps and backoff.
+        request_kwargs: Further arguments of async_request_data, e.g. head_first.
+    Yields:
+        tuple[int, httpx.Response]: Index of the URL and its HTTP response.
+    """
+    responses = asyncio.Queue()
+    slots = asyncio.Semaphore(max_concurrency)
+
+    async def worker(pending):
+        # Workers of a host share its iterator, each taking the next URL once its request is done
+        for index in pending:
+            url = urls[index]
+            try:
+                response = await async_request_data(
+                    client, url, limiter, host_limiters=host_limiters, slots=slots, **request_kwargs
+                )
+            except Exception as e:
+                response = handle_exception(url, e)
+            await responses.put((index, response))
+
+    host_workers = host_limiters.max_connections if host_limiters else max_concurrency
+    workers = []
+    for indices in group_by_host(urls, host_limiters).values():
+        pending = iter(indices)
+        workers += [
+            asyncio.create_task(worker(pending)) for _ in range(min(host_workers, len(indices)))
+        ]
+    try:
+        for _ in range(len(urls)):
+            yield await responses.get()
+    finally:
+        for task in workers:
+            task.cancel()
+
+
+def group_by_host(urls, host_limiters):
+    """
+    Group URLs by the HostLimiter of their host, all in a single group without host_limiters.
+
+    Args:
+        urls (list): List of URLs.
+        host_limiters (HostLimiters): Per-host rate limiters, connection caps and backoff, or None.
+
     Returns:
-        list[httpx.Response]: List of HTTP responses.
+        dict[HostLimiter, list[int]]: The indices of the URLs of each host, in the order of the URLs.
     """
-    tasks = [async_request_data(client, url, limiter) for url in urls]
-    responses = await asyncio.gather(*tasks)
-    return responses
+    groups = defaultdict(list)
+    for index, url in enumerate(urls):
+        groups[host_limiters.get(url) if host_limiters else None].append(index)
+    return groups
 
 
-def sync_request_data(client, url, retry_count=3):
+def get_retry_delay(response, attempt, initial_delay, max_delay):
     """
-    Synchronously request data from a URL using an HTTP client.
+    Get the delay before the next attempt to request a URL.
+
+    The delay doubles with each attempt up to max_delay and half of it is random, so retries
+    of URLs which failed together are spread out. It is never shorter than the delay asked
+    by the Retry-After header of the response.
 
     Args:
-        client (httpx.Client): The HTTP client to use.
-        url (str): The URL to request data from.
-        retry_count (int): The maximum number of retries for failed requests.
+        response (httpx.Response or None): The response to the last attempt, if it is known.
+        attempt (int): The number of requests of the URL so far, including the last one.
+        initial_delay (float): The delay before the first retry in seconds.
+        max_delay (float): The maximum delay in seconds, besides Retry-After.
 
     Returns:
-        httpx.Response: The HTTP response.
+        float: The delay in seconds.
+    """
+    backoff = min(initial_delay * 2 ** (attempt - 1), max_delay)
+    delay = backoff / 2 + random.uniform(0, backoff / 2)
+    retry_after = get_retry_after(response) if response is not None else None
+    return max(delay, retry_after or 0.0)
+
+
+async def iter_retried_responses(
+    client,
+    urls,
+    limiter,
+    should_retry,
+    max_retries,
+    initial_delay,
+    max_delay,
+    max_concurrency,
+    host_limiters=None,
+    previous_responses=None,
+    **request_kwargs,
+):
+    """
+    Asynchronously retry requests to URLs, each URL with its own backoff.
+
+    URLs wait in a priority queue ordered by the time they may be requested again, and are
+    requested as soon as that time has come, with at most max_concurrency requests in flight.
+    With host_limiters, a host has at most its connection cap of requests started, the other
+    URLs of the host wait for one of them to complete, and a request takes one of the
+    max_concurrency slots only once its host has capacity.
+    A URL is retried as long as should_retry returns True for its response, at most max_retries
+    times, after the delay given by get_retry_delay. URLs in previous_responses were already
+    requested once, so they start with their first retry, after the delay given for their
+    previous response, and the other URLs are requested at once. Each response is yielded
+    together with whether it is the final one of its URL. Closing the generator cancels the
+    requests in flight.
+
+    Args:
+        client (httpx.AsyncClient): The HTTP client to use.
+        urls (list): List of URLs to retry.
+        limiter (aiolimiter.AsyncLimiter): An async limiter for rate limiting.
+        should_retry (Callable[[httpx.Response], bool]): Whether a response needs another retry.
+        max_retries (int): The maximum number of retries of a URL.
+        initial_delay (float): The delay before the first retry in seconds.
+        max_delay (float): The maximum delay between retries in seconds, besides Retry-After.
+        max_concurrency (int): The maximum number of concurrent requests.
+        host_limiters (HostLimiters): Per-host rate limiters, connection caps and backoff.
+        previous_responses (dict[str, httpx.Response or None]): The response to the request
+            already made to each of these URLs, None if it is not known.
+        request_kwargs: Further arguments of async_request_data, e.g. head_first.
+    Yields:
+        tuple[str, httpx.Response, bool]: The URL, the response to each request and whether
+        the URL is not requested again.
     """
+    order = itertools.count()
+    previous_responses = previous_responses or {}
+    now = time.monotonic()
+    queue = []
+    for url in urls:
+        if url not in previous_responses:
+            queue.append((now, next(order), url, 1))
+        elif max_retries > 0:
+            delay = get_retry_delay(previous_responses[url], 1, initial_delay, max_delay)
+            queue.append((now + delay, next(order), url, 2))
+    heapq.heapify(queue)
+    in_flight = {}
+    slots = asyncio.Semaphore(max_concurrency)
+    host_cap = host_limiters.max_connections if host_limiters else max_concurrency
+    # Requests started and eligible URLs waiting for one of them to complete, of each host
+    host_requests = defaultdict(int)
+    host_waiting = defaultdict(deque)
+
+    def start(host, url, attempt):
+        # Retries are scheduled here only, so a 429 is not retried by async_request_data too
+        task = asyncio.create_task(
+            async_request_data(
+                client,
+                url,
+                limiter,
+                retry_count=0,
+                host_limiters=host_limiters,
+                slots=slots,
+                **request_kwargs,
+            )
+        )
+        in_flight[task] = (host, url, attempt)
+        host_requests[host] += 1
+
     try:
-        response = client.get(url, follow_redirects=True, timeout=30.0)
-        return response
-    except (httpx.RequestError, httpx.TimeoutException, httpx.ConnectError) as e:
-        return handle_exception(url, e)
+        while queue or in_flight:
+            while queue and queue[0][0] <= time.monotonic():
+                _, _, url, attempt = heapq.heappop(queue)
+                host = host_limiters.get(url) if host_limiters else None
+                if host_requests[host] < host_cap:
+                    start(host, url, attempt)
+                else:
+                    host_waiting[host].append((url, attempt))
+
+            # Wait for a request to complete or for the next eligible URL
+            timeout = max(queue[0][0] - time.monotonic(), 0.0) if queue else None
+            if not in_flight:
+                await asyncio.sleep(timeout)
+                continue
+            done, _ = await asyncio.wait(in_flight, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+
+            for task in done:
+                host, url, attempt = in_flight.pop(task)
+                host_requests[host] -= 1
+                if host_waiting[host]:
+                    start(host, *host_waiting[host].popleft())
+                elif not host_requests[host]:
+                    del host_requests[host], host_waiting[host]
+                try:
+                    response = task.result()
+                except Exception as e:
+                    response = handle_exception(url, e)
+                # The first request is not a retry, so a URL is requested up to max_retries + 1 times
+                final = not should_retry(response) or attempt > max_retries
+                if not final:
+                    delay = get_retry_delay(response, attempt, initial_delay, max_delay)
+                    heapq.heappush(queue, (time.monotonic() + delay, next(order), url, attempt + 1))
+                yield url, response, final
+    finally:
+        for task in in_flight:
+            task.cancel()
+
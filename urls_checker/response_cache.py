@@ -0,0 +1,101 @@
+import json
+import sqlite3
+import time
+
+# Maximum number of URLs looked up in a single query
+LOOKUP_BATCH_SIZE = 500
+
+
+class ResponseCache:
+    """
+    Persistent cache of the response records of URLs, stored in a SQLite database.
+
+    Records older than ttl seconds are not returned and are removed by evict, which also
+    removes the oldest records once there are more than max_entries of them.
+
+    Args:
+        path (str): The path of the SQLite database.
+        ttl (float): The time, in seconds, a record is valid for.
+        max_entries (int): The maximum number of records kept by evict.
+    """
+
+    def __init__(self, path, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.connection = sqlite3.connect(path)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS responses "
+            "(url TEXT PRIMARY KEY, record TEXT NOT NULL, fetched_at REAL NOT NULL)"
+        )
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS responses_fetched_at ON responses (fetched_at)"
+        )
+        self.connection.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def get_many(self, urls):
+        """
+        Get the valid records of URLs.
+
+        Args:
+            urls (list[str]): The URLs to look up.
+
+        Returns:
+            dict: The record of each URL found in the cache, keyed by URL.
+        """
+        urls = list(dict.fromkeys(urls))
+        valid_from = time.time() - self.ttl
+        records = {}
+        for start in range(0, len(urls), LOOKUP_BATCH_SIZE):
+            batch = urls[start : start + LOOKUP_BATCH_SIZE]
+            rows = self.connection.execute(
+                f"SELECT url, record FROM responses "
+                f"WHERE url IN ({', '.join('?' * len(batch))}) AND fetched_at >= ?",
+                [*batch, valid_from],
+            )
+            records.update((url, json.loads(record)) for url, record in rows)
+        return records
+
+    def put_many(self, records):
+        """
+        Store the records of URLs, replacing their previous records.
+
+        Args:
+            records (list[dict]): The records, each with the URL under the "url" key.
+        """
+        fetched_at = time.time()
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO responses (url, record, fetched_at) VALUES (?, ?, ?)",
+            [
+                (
+                    record["url"],
+                    json.dumps({key: value for key, value in record.items() if key != "url"}),
+                    fetched_at,
+                )
+                for record in records
+            ],
+        )
+        self.connection.commit()
+
+    def evict(self):
+        """Remove the expired records and the oldest records above max_entries."""
+        self.connection.execute(
+            "DELETE FROM responses WHERE fetched_at < ?", [time.time() - self.ttl]
+        )
+        (entries,) = self.connection.execute("SELECT COUNT(*) FROM responses").fetchone()
+        if entries > self.max_entries:
+            self.connection.execute(
+                "DELETE FROM responses WHERE url IN "
+                "(SELECT url FROM responses ORDER BY fetched_at LIMIT ?)",
+                [entries - self.max_entries],
+            )
+        self.connection.commit()
+
+    def close(self):
+        """Close the database."""
+        self.connection.close()
@@ -0,0 +1,57 @@
+from collections import Counter
+
+import pandas as pd
+
+from utils import draw_stratified_sample, get_sample_strata
+
+
+def make_urls_by_publisher(urls_counts):
+    """Make the URLs grouped by publisher, with the given number of URLs of each publisher."""
+    return pd.DataFrame(
+        {
+            "publisher": [f"publisher{index}" for index in range(len(urls_counts))],
+            "urls": [
+                [f"https://publisher{index}.org/{url}" for url in range(count)]
+                for index, count in enumerate(urls_counts)
+            ],
+            "urls_count": urls_counts,
+        }
+    )
+
+
+def test_sample_with_more_top_publishers_than_publishers():
+    urls_by_publisher = make_urls_by_publisher([40, 30, 20, 10])
+
+    strata, sample_counts = get_sample_strata(urls_by_publisher, 100, 0.5)
+    sample = draw_stratified_sample(urls_by_publisher, strata, sample_counts, 1)
+
+    # Every publisher is a stratum of its own and the rest stratum is empty
+    assert sample_counts == [20, 15, 10, 5, 0]
+    assert Counter(publisher for publisher, _ in sample) == {
+        "publisher0": 20,
+        "publisher1": 15,
+        "publisher2": 10,
+        "publisher3": 5,
+    }
+
+
+def test_sample_counts_are_clamped_to_the_strata():
+    # Rounding gives each of the 4 top publishers a URL, more than the 3 URLs of the sample
+    urls_by_publisher = make_urls_by_publisher([1, 1, 1, 1, 1])
+
+    strata, sample_counts = get_sample_strata(urls_by_publisher, 4, 0.6)
+    sample = draw_stratified_sample(urls_by_publisher, strata, sample_counts, 1)
+
+    assert sample_counts == [1, 1, 1, 1, 0]
+    assert len(sample) == 4
+
+
+def test_sample_is_reproducible_per_seed():
+    urls_by_publisher = make_urls_by_publisher([500, 300, 200, 100, 50])
+    strata, sample_counts = get_sample_strata(urls_by_publisher, 2, 0.1)
+
+    sample = draw_stratified_sample(urls_by_publisher, strata, sample_counts, 1)
+
+    assert sample == draw_stratified_sample(urls_by_publisher, strata, sample_counts, 1)
+    assert sample != draw_stratified_sample(urls_by_publisher, strata, sample_counts, 2)
+    assert len(set(sample)) == sum(sample_counts) == 115
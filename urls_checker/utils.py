@@ -1,16 +1,206 @@
-import re
+import json
+import logging
+import os
 
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 
-def extract_response_code(response):
+# Schema of the saved results, one record per requested URL
+RESULTS_SCHEMA = pa.schema(
+    [
+        ("publisher", pa.string()),
+        ("url", pa.string()),
+        ("response_code", pa.int64()),
+        ("error", pa.string()),
+        ("final_url", pa.string()),
+        ("redirects", pa.int64()),
+        ("elapsed", pa.float64()),
+        ("content_length", pa.int64()),
+    ]
+)
+
+
+def save_results(results_df, path):
+    """
+    Save the response records to a Parquet file.
+
+    Args:
+        results_df (pd.DataFrame): The response records, with the columns of RESULTS_SCHEMA.
+        path (str): The path of the Parquet file.
+    """
+    table = pa.Table.from_pandas(results_df, schema=RESULTS_SCHEMA, preserve_index=False)
+    pq.write_table(table, path)
+    logging.info(f"File saved: {path}")
+
+
+def load_results(path):
+    """
+    Load the response records saved by save_results.
+
+    Args:
+        path (str): The path of the Parquet file.
+
+    Returns:
+        pd.DataFrame: The response records.
+    """
+    return pq.read_table(path).to_pandas(types_mapper={pa.int64(): pd.Int64Dtype()}.get)
+
+
+def merge_retry_responses(sample_df, retry_responses):
+    """
+    Update the responses of the sample with the responses of the retried URLs, joined by URL.
+
+    Args:
+        sample_df (pd.DataFrame): The responses of the sample, updated in place.
+        retry_responses (pd.DataFrame): The responses of the retried URLs.
+
+    Returns:
+        pd.Index: The index of the updated rows of the sample.
+    """
+    retry_responses = retry_responses.drop_duplicates("url", keep="last").set_index("url")
+    updated_rows = sample_df.index[sample_df["url"].isin(retry_responses.index)]
+    response_columns = retry_responses.columns
+    sample_df.loc[updated_rows, response_columns] = retry_responses.loc[
+        sample_df.loc[updated_rows, "url"], response_columns
+    ].to_numpy()
+    return updated_rows
+
+
+def append_results(results_df, log_path):
+    """
+    Append response records to a JSON lines log.
+
+    Args:
+        results_df (pd.DataFrame): The response records.
+        log_path (str): The path of the log.
+    """
+    with open(log_path, "a") as file:
+        results_df.to_json(file, orient="records", lines=True)
+        file.flush()
+        os.fsync(file.fileno())
+
+
+def compact_results(path, log_path):
+    """
+    Apply the response records logged by append_results to the records saved by save_results,
+    later records of a URL replacing earlier ones, and remove the log.
+
+    Running it again after a crash recovers every response logged before the crash.
+
+    Args:
+        path (str): The path of the Parquet file.
+        log_path (str): The path of the log.
+    """
+    if not os.path.exists(log_path):
+        return
+
+    results_df = load_results(path)
+    retry_responses = []
+    with open(log_path, "r") as file:
+        for line in file:
+            try:
+                retry_responses.append(json.loads(line))
+            except json.JSONDecodeError:
+                # The last line is incomplete if the run was killed while writing it
+                continue
+    if retry_responses:
+        merge_retry_responses(results_df, pd.DataFrame(retry_responses))
+        save_results(results_df, path)
+    os.remove(log_path)
+
+
+def get_sample_strata(urls_by_publisher, top_publishers, sample):
+    """
+    Split the publishers into the strata of the sample, each of the top_publishers publishers
+    with the most URLs in a stratum of its own and the rest publishers in the last one, which
+    is empty if there are no other publishers.
+
+    Args:
+        urls_by_publisher (pd.DataFrame): The URLs and the number of URLs of each publisher.
+        top_publishers (int): The number of publishers sampled as strata of their own.
+        sample (float): The share of all URLs in the sample.
+
+    Returns:
+        tuple[np.ndarray, list[int]]: The stratum of each publisher and the number of URLs
+        sampled from each stratum, at most the number of URLs of the stratum.
+    """
+    # Calculate URL statistics
+    total_urls = urls_by_publisher["urls_count"].sum()
+    urls_percentage = urls_by_publisher["urls_count"] / total_urls * 100
+
+    # Calculate top publishers by URLs
+    top_publishers_by_urls = (
+        urls_percentage.to_frame("urls_percentage")
+        .sort_values(by="urls_percentage", ascending=False)
+        .head(top_publishers)
+    )
+
+    urls_total_sample = int(round(total_urls * sample, 0))
+    top_publishers_by_urls.loc[:, "sample_count"] = round(
+        top_publishers_by_urls["urls_percentage"] * urls_total_sample / 100, 0
+    )
+
+    rest_sample = round(
+        urls_total_sample - top_publishers_by_urls["sample_count"].sum(), 0
+    )
+
+    # Each top publisher is a stratum of its own, the rest publishers share the last one
+    publisher_strata = np.full(len(urls_by_publisher), len(top_publishers_by_urls))
+    publisher_strata[urls_by_publisher.index.get_indexer(top_publishers_by_urls.index)] = np.arange(
+        len(top_publishers_by_urls)
+    )
+
+    # Rounding may ask for more URLs than a stratum has, or for less than none
+    top_sizes = urls_by_publisher.loc[top_publishers_by_urls.index, "urls_count"].to_numpy()
+    stratum_sizes = np.append(top_sizes, total_urls - top_sizes.sum())
+    strata_sample_counts = np.clip(
+        np.append(top_publishers_by_urls["sample_count"].to_numpy(), rest_sample), 0, stratum_sizes
+    )
+    return publisher_strata, strata_sample_counts.astype(int).tolist()
+
+
+def draw_stratified_sample(urls_by_publisher, strata, sample_counts, seed):
     """
-    Extract the response code from a string containing a response.
+    Draw a stratified sample of URLs without exploding the URLs of the publishers.
+
+    The URLs of each stratum are numbered consecutively, publisher after publisher, and the
+    sample of each stratum is drawn as positions in this numbering, which are then mapped back
+    to the publisher and URL they point to. Only the sampled URLs are ever materialised.
 
     Args:
-        response (str): The response string to extract the code from.
+        urls_by_publisher (pd.DataFrame): The URLs and the number of URLs of each publisher.
+        strata (np.ndarray): The stratum of each publisher, numbered from 0.
+        sample_counts (list[int]): The number of URLs drawn from each stratum.
+        seed (int): The seed of the random generator, the same seed draws the same sample.
+
     Returns:
-        int or None: The extracted response code as an integer, or None if not found
+        list[tuple[str, str]]: The publisher and URL of each sampled URL, stratum after stratum.
     """
-    match = re.search(r"\[(\d+)\s*(?:\w+\s*)*\]", str(response))
-    if match:
-        return int(match.group(1))
-    return None
+    rng = np.random.default_rng(seed)
+    counts = urls_by_publisher["urls_count"].to_numpy()
+
+    # Publishers ordered by stratum, with the position of their first URL
+    order = np.argsort(strata, kind="stable")
+    offsets = np.concatenate([[0], np.cumsum(counts[order])])
+    stratum_sizes = np.bincount(strata, weights=counts, minlength=len(sample_counts)).astype(np.int64)
+    stratum_offsets = np.concatenate([[0], np.cumsum(stratum_sizes)])
+
+    positions = np.concatenate(
+        [
+            stratum_offsets[stratum]
+            + rng.choice(stratum_sizes[stratum], size=min(int(count), stratum_sizes[stratum]), replace=False)
+            for stratum, count in enumerate(sample_counts)
+            # A stratum may be empty, e.g. the rest publishers if all are top publishers
+            if stratum_sizes[stratum] > 0
+        ]
+        + [np.empty(0, dtype=np.int64)]
+    )
+    publisher_positions = np.searchsorted(offsets, positions, side="right") - 1
+    rows = order[publisher_positions]
+    url_indices = positions - offsets[publisher_positions]
+
+    publishers = urls_by_publisher["publisher"].to_numpy()
+    urls = urls_by_publisher["urls"].to_numpy()
+    return [(publishers[row], urls[row][index]) for row, index in zip(rows, url_indices)]